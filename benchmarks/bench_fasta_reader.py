@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+from ervin.ervin_utils import iter_fasta_file
+from ervin.ervin_utils import read_and_sanitise_raw_data
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+DEFAULT_SIZES = [1000, 5000, 10000, 25000, 100000]
+DEFAULT_LEGACY_LIMIT = 25000
+
+
+def legacy_read_from_fasta_file(filename):
+    # The list based reader that iter_fasta_file replaced
+    input_data = read_and_sanitise_raw_data(filename)
+    fasta_titles = [line for line in input_data if ">" in line]
+    title_indices = [input_data.index(title) for title in fasta_titles]
+    parsed_file_data = []
+    for i in range(len(title_indices)):
+        try:
+            sequence = "".join(input_data[title_indices[i]+1:title_indices[i+1]])
+            parsed_file_data.append({"title": input_data[title_indices[i]], "seq": sequence})
+        except IndexError:
+            sequence = "".join(input_data[title_indices[i] + 1:])
+            parsed_file_data.append({"title": input_data[title_indices[i]], "seq": sequence})
+    return parsed_file_data
+
+
+def streaming_read(filename):
+    # One record at a time, as virus_blaster reads them
+    record_count = 0
+    for _ in iter_fasta_file(filename):
+        record_count += 1
+    return record_count
+
+
+def write_merged_fasta(filepath, record_count):
+    generator = random.Random(record_count)
+    with open(filepath, "w") as fasta_out:
+        for count in range(record_count):
+            sequence = "".join(generator.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(300))
+            fasta_out.write(f">scaf{count % 500} {count * 10} {count * 10 + 900} P\n{sequence}\n")
+
+
+def measure(reader, filepath):
+    tracemalloc.start()
+    started = time.perf_counter()
+    reader(filepath)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes",
+                        help="Numbers of fasta records to benchmark",
+                        type=int,
+                        nargs="*",
+                        default=DEFAULT_SIZES)
+    parser.add_argument("-l", "--legacy_limit",
+                        help="Largest record count to run the quadratic legacy reader on",
+                        type=int,
+                        default=DEFAULT_LEGACY_LIMIT)
+    return parser.parse_args()
+
+
+def run_benchmark():
+    bench_args = parse_args()
+    print(f"{'records':>8} {'legacy (s)':>11} {'legacy MiB':>11} {'stream (s)':>11} {'stream MiB':>11}")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in bench_args.sizes:
+            filepath = os.path.join(work_dir, f"merged_{size}.fasta")
+            write_merged_fasta(filepath, size)
+            if size <= bench_args.legacy_limit:
+                legacy_time, legacy_peak = measure(legacy_read_from_fasta_file, filepath)
+                legacy = f"{legacy_time:>11.3f} {legacy_peak:>11.1f}"
+            else:
+                legacy = f"{'-':>11} {'-':>11}"
+            stream_time, stream_peak = measure(streaming_read, filepath)
+            print(f"{size:>8} {legacy} {stream_time:>11.3f} {stream_peak:>11.1f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
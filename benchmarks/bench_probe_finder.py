@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+from ervin.probe_data import ProbeData
+from ervin.probe_finder import Args
+from ervin.probe_finder import merge_scaffold_records
+from ervin.probe_finder import merge_scaffold_records_pairwise
+
+import argparse
+import random
+import time
+
+DEFAULT_SIZES = [10, 50, 100, 250, 500, 1000, 2500, 5000]
+SCAFFOLD_HITS_PER_KB = 0.5
+
+
+def make_scaffold_records(record_count, seed):
+    generator = random.Random(seed)
+    # Keep hit density roughly constant as the scaffold grows, as it does in real genomes
+    scaffold_length = int(record_count * 1000 / SCAFFOLD_HITS_PER_KB)
+    records = []
+    for count in range(record_count):
+        start = generator.randrange(1, scaffold_length) // 3 * 3
+        end = start + generator.randrange(30, 600) * 3 + 1
+        frame = generator.choice([1, 2, 3, -1, -2, -3])
+        first, second = (start, end) if frame > 0 else (end, start)
+        alignment = "ACGT" * ((end - start) // 12)
+        records.append(ProbeData(f"acc{count}\tscaf\t{scaffold_length}\t{first}\t{second}\t1e-50\t"
+                                 f"{generator.randrange(300, 700)}\tMKLV\t{alignment}\t{frame}"))
+    return records
+
+
+def time_merge(merge_scaffold, args, records, repeats):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        merge_scaffold(args, records, records)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes",
+                        help="Numbers of hits per scaffold to benchmark",
+                        type=int,
+                        nargs="*",
+                        default=DEFAULT_SIZES)
+    parser.add_argument("-r", "--repeats",
+                        help="Number of timed runs per size, the best of which is reported",
+                        type=int,
+                        default=3)
+    return parser.parse_args()
+
+
+def run_benchmark():
+    bench_args = parse_args()
+    args = Args([], None)
+    print(f"{'hits':>8} {'pairwise (s)':>14} {'indexed (s)':>14} {'speedup':>9}")
+    for size in bench_args.sizes:
+        records = make_scaffold_records(size, seed=size)
+        pairwise = time_merge(merge_scaffold_records_pairwise, args, records, bench_args.repeats)
+        indexed = time_merge(merge_scaffold_records, args, records, bench_args.repeats)
+        print(f"{size:>8} {pairwise:>14.5f} {indexed:>14.5f} {pairwise / indexed:>8.1f}x")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+from ervin.probe_data import ProbeData
+from ervin.probe_finder import ProbeFinderWriter
+from ervin.probe_finder import set_up_output_files
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+DEFAULT_SIZES = [1000, 10000, 50000, 200000]
+DEFAULT_LEGACY_LIMIT = 50000
+MODES = [None, "gzip", "bgzip"]
+
+
+def legacy_write_to_files(output_files, record):
+    # The per-record writer ProbeFinderWriter replaced, reopening both outputs for every record
+    (fasta_output, tsv_output) = output_files
+    with open(fasta_output, "a") as fasta:
+        with open(tsv_output, "a") as tsv:
+            fasta.write(record.to_fasta())
+            tsv.write(record.to_tsv())
+
+
+def make_merged_records(record_count):
+    generator = random.Random(record_count)
+    records = []
+    for count in range(record_count):
+        start = count * 1000 + 1
+        end = start + generator.randrange(300, 900) * 3
+        alignment = "".join(generator.choice("ACDEFGHIKLMNPQRSTVWY-") for _ in range((end - start) // 3))
+        records.append(ProbeData(f"acc{count}\tscaf{count % 500}\t100000000\t{start}\t{end}\t1e-50\t"
+                                 f"{len(alignment)}\tMKLV\t{alignment}\t1"))
+    return records
+
+
+def legacy_write(output_dir, records):
+    output_files = set_up_output_files(output_dir, "legacy")
+    for output_file in output_files:
+        open(output_file, "w").close()
+    for record in records:
+        legacy_write_to_files(output_files, record)
+    return output_files
+
+
+def buffered_write(output_dir, records, compression):
+    output_files = set_up_output_files(output_dir, compression or "plain", compression)
+    with ProbeFinderWriter(output_files, compression) as writer:
+        writer.write_records(records)
+    return output_files
+
+
+def measure(write, *args):
+    started = time.perf_counter()
+    output_files = write(*args)
+    elapsed = time.perf_counter() - started
+    size = sum(os.path.getsize(output_file) for output_file in output_files)
+    return elapsed, size / 1024 / 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes",
+                        help="Numbers of merged records to write",
+                        type=int,
+                        nargs="*",
+                        default=DEFAULT_SIZES)
+    parser.add_argument("-l", "--legacy_limit",
+                        help="Largest record count to run the per-record legacy writer on",
+                        type=int,
+                        default=DEFAULT_LEGACY_LIMIT)
+    parser.add_argument("-o", "--output_dir",
+                        help="Directory to write into, such as one on the network filesystem a run would use",
+                        type=str,
+                        required=False)
+    return parser.parse_args()
+
+
+def run_benchmark():
+    bench_args = parse_args()
+    columns = ["legacy", *(mode or "buffered" for mode in MODES)]
+    print(f"{'records':>8} " + " ".join(f"{column + ' (s)':>14} {column + ' MiB':>14}" for column in columns))
+    for size in bench_args.sizes:
+        records = make_merged_records(size)
+        with tempfile.TemporaryDirectory(dir=bench_args.output_dir) as work_dir:
+            if size <= bench_args.legacy_limit:
+                legacy_time, legacy_size = measure(legacy_write, work_dir, records)
+                cells = [f"{legacy_time:>14.3f} {legacy_size:>14.1f}"]
+            else:
+                cells = [f"{'-':>14} {'-':>14}"]
+            for mode in MODES:
+                elapsed, output_size = measure(buffered_write, work_dir, records, mode)
+                cells.append(f"{elapsed:>14.3f} {output_size:>14.1f}")
+        print(f"{size:>8} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,149 @@
+from pathlib import Path
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+SQLITE_TIMEOUT = 30
+
+LOGGER = logging.getLogger(Path(__file__).stem)
+
+
+def sequence_hash(sequence):
+    return hashlib.sha256(sequence.encode()).hexdigest()
+
+
+def probe_hit_key(db_identity, e_value_threshold, title, sequence):
+    return hashlib.sha256("\0".join([db_identity, str(e_value_threshold), title, sequence]).encode()).hexdigest()
+
+
+def genome_db_identity(db_path):
+    # A BLAST database is a family of files sharing a prefix, so a rebuild changes the size or mtime of one of them
+    db_path = Path(db_path)
+    db_files = sorted(db_path.parent.glob(f"{db_path.name}.*"))
+    file_stats = [f"{db_file.name}:{db_file.stat().st_size}:{db_file.stat().st_mtime_ns}" for db_file in db_files]
+    return f"{db_path.resolve()}|{'|'.join(file_stats)}"
+
+
+class SqliteCache:
+    """Base for the BLAST result caches: a single SQLite table with least recently used eviction"""
+
+    TABLE = None
+    KEY_COLUMNS = None
+    # Column definitions for the table, which must include a REAL last_used column for eviction
+    COLUMNS = None
+
+    def __init__(self, cache_path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Shared by the BLAST worker threads, with the lock serialising access
+        self._connection = sqlite3.connect(str(cache_path), timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} ({self.COLUMNS})")
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_last_used "
+                                     f"ON {self.TABLE} (last_used)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def _touch(self, keys):
+        key_clause = " AND ".join(f"{column} = ?" for column in self.KEY_COLUMNS)
+        now = time.time()
+        self._connection.executemany(f"UPDATE {self.TABLE} SET last_used = ? WHERE {key_clause}",
+                                     [(now, *key) for key in keys])
+
+    def _evict(self):
+        excess = self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._connection.execute(f"DELETE FROM {self.TABLE} WHERE rowid IN "
+                                     f"(SELECT rowid FROM {self.TABLE} ORDER BY last_used LIMIT ?)", (excess,))
+
+
+class TopHitCache(SqliteCache):
+    """Persistent map from query sequence to its top tblastn hit against one version of a BLAST database"""
+
+    TABLE = "top_hits"
+    KEY_COLUMNS = ("sequence_hash", "db")
+    COLUMNS = ("sequence_hash TEXT NOT NULL, db TEXT NOT NULL, db_version TEXT NOT NULL, top_hit TEXT NOT NULL, "
+               "last_used REAL NOT NULL, PRIMARY KEY (sequence_hash, db)")
+
+    def __init__(self, cache_path, db, db_version, max_entries):
+        self.db = db
+        self.db_version = str(db_version)
+        super().__init__(cache_path, max_entries)
+        with self._lock, self._connection:
+            removed = self._connection.execute("DELETE FROM top_hits WHERE db = ? AND db_version != ?",
+                                               (self.db, self.db_version)).rowcount
+        if removed:
+            LOGGER.info(f"Dropped {removed} cached top hits from older versions of {db}")
+
+    def get_many(self, sequences):
+        hashes = [sequence_hash(sequence) for sequence in sequences]
+        found = {}
+        with self._lock, self._connection:
+            for hash_value in set(hashes):
+                row = self._connection.execute("SELECT top_hit FROM top_hits "
+                                               "WHERE sequence_hash = ? AND db = ? AND db_version = ?",
+                                               (hash_value, self.db, self.db_version)).fetchone()
+                if row is not None:
+                    found[hash_value] = row[0]
+            self._touch([(hash_value, self.db) for hash_value in found])
+        return [found.get(hash_value) for hash_value in hashes]
+
+    def put_many(self, sequences, top_hits):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO top_hits VALUES (?, ?, ?, ?, ?)",
+                                         [(sequence_hash(sequence), self.db, self.db_version, top_hit, now)
+                                          for sequence, top_hit in zip(sequences, top_hits)])
+            self._evict()
+
+
+class ProbeHitCache(SqliteCache):
+    """Persistent store of the raw tblastn rows for each probe, addressed by probe, genome database and e-value"""
+
+    TABLE = "probe_hits"
+    KEY_COLUMNS = ("probe_key",)
+    COLUMNS = "probe_key TEXT PRIMARY KEY, hit_lines BLOB NOT NULL, last_used REAL NOT NULL"
+
+    def __init__(self, cache_path, db_identity, e_value_threshold, max_entries):
+        self.db_identity = db_identity
+        self.e_value_threshold = e_value_threshold
+        super().__init__(cache_path, max_entries)
+
+    def _probe_key(self, probe):
+        return probe_hit_key(self.db_identity, self.e_value_threshold, probe["title"], probe["seq"])
+
+    def get_many(self, probes):
+        keys = [self._probe_key(probe) for probe in probes]
+        found = {}
+        with self._lock, self._connection:
+            for key in set(keys):
+                row = self._connection.execute("SELECT hit_lines FROM probe_hits WHERE probe_key = ?",
+                                               (key,)).fetchone()
+                if row is not None:
+                    found[key] = zlib.decompress(row[0]).decode().splitlines()
+            self._touch([(key,) for key in found])
+        return [found.get(key) for key in keys]
+
+    def put_many(self, probes, hit_lines):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO probe_hits VALUES (?, ?, ?)",
+                                         [(self._probe_key(probe), zlib.compress("\n".join(lines).encode()), now)
+                                          for probe, lines in zip(probes, hit_lines)])
+            self._evict()
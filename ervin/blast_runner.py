@@ -0,0 +1,111 @@
+from .ervin_utils import get_config
+
+from .exceptions import BlastTimeoutException
+
+from functools import lru_cache
+from pathlib import Path
+
+import logging
+import os
+import subprocess
+import threading
+
+STDIN_QUERY = "-"
+STDERR_LIMIT = 64 * 1024
+
+LOGGER = logging.getLogger(Path(__file__).stem)
+
+
+def build_blast_command(program, query=None, **options):
+    # Options follow the BLAST+ convention of -name value, with a value of True giving a bare flag
+    command = [program]
+    if query is not None:
+        command.extend(["-query", STDIN_QUERY])
+    for name, value in options.items():
+        if value is None or value is False:
+            continue
+        command.append(f"-{name}")
+        if value is not True:
+            command.append(str(value))
+    return command
+
+
+def write_query(stdin, query):
+    try:
+        stdin.write(query.encode())
+    except (BrokenPipeError, ConnectionResetError):
+        # The exit status and stderr explain why the program stopped reading
+        pass
+    finally:
+        try:
+            stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class BlastRunner:
+    """Runs BLAST+ programs as subprocesses, at most max_concurrent at a time across every calling thread"""
+
+    def __init__(self, max_concurrent=None, timeout=None):
+        self.max_concurrent = max_concurrent if max_concurrent else os.cpu_count() or 1
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+
+    def run(self, program, query=None, parse_line=None, **options):
+        # Yields each line of output, parsed, as soon as the program writes it
+        command = build_blast_command(program, query, **options)
+        LOGGER.debug(command)
+        with self._slots:
+            process = subprocess.Popen(command,
+                                       stdin=subprocess.PIPE if query is not None else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            timed_out = threading.Event()
+
+            def kill_on_timeout():
+                if process.poll() is None:
+                    timed_out.set()
+                    process.kill()
+
+            timer = threading.Timer(self.timeout, kill_on_timeout) if self.timeout is not None else None
+            # stdin and stderr get threads of their own, so neither pipe can stall stdout
+            threads = [start_thread(write_query, process.stdin, query)] if query is not None else []
+            stderr = []
+            threads.append(start_thread(lambda: stderr.append(process.stderr.read())))
+            try:
+                if timer is not None:
+                    timer.start()
+                for line in process.stdout:
+                    decoded_line = line.decode().rstrip("\r\n")
+                    yield parse_line(decoded_line) if parse_line else decoded_line
+                returncode = process.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                for thread in threads:
+                    thread.join()
+                process.stdout.close()
+                process.stderr.close()
+            if timed_out.is_set():
+                raise BlastTimeoutException(f"{program} did not finish within {self.timeout} seconds")
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command, stderr=stderr[0][-STDERR_LIMIT:])
+
+
+@lru_cache(maxsize=None)
+def get_blast_runner():
+    config = get_config()
+    return BlastRunner(config.blast_concurrency, config.blast_timeout)
+
+
+def run_blast_program(program, query=None, parse_line=None, **options):
+    return get_blast_runner().run(program, query, parse_line, **options)
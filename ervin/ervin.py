@@ -1,15 +1,45 @@
+from .probe_finder import OUTPUT_COMPRESSIONS
+from .probe_finder import iter_merged_scaffolds
 from .probe_finder import run_probe_finder
+from .probe_finder import run_probe_finder_on_records
+from .probe_finder import write_probe_finder_results
 
-from .probe_blaster import run_probe_blaster
+from .probe_blaster import blast_probes
 
 from .ervin_utils import DEFAULT_OUTPUT_DIR
+from .ervin_utils import TEMP_PROBE_BLASTER
 from .ervin_utils import ensure_output_dir_exists
 from .ervin_utils import format_timestamp_for_filename
+from .ervin_utils import iter_fasta_file
+
+from .probe_blaster import print_results
+
+from .probe_store import PROBE_STORE_SUFFIX
+from .probe_store import append_probe_store
+from .probe_store import count_probe_records
+from .probe_store import read_probe_store
+
+from .run_checkpoint import RunCheckpoint
 
 from .virus_blaster import VIRUS_DB_DEFAULT
+from .virus_blaster import ensure_virus_db_current
 from .virus_blaster import run_virus_blaster
+from .virus_blaster import run_virus_blaster_on_records
+
+from contextlib import closing
+from pathlib import Path
 
 import argparse
+import logging
+import queue
+import threading
+
+PROBE_BLASTER_STAGE = "probe_blaster"
+PROBE_FINDER_STAGE = "probe_finder"
+VIRUS_BLASTER_STAGE = "virus_blaster"
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_DRAIN_INTERVAL = 0.1
+LOGGER = logging.getLogger(Path(__file__).stem)
 
 
 def get_args():
@@ -17,7 +47,7 @@ def get_args():
     parser.add_argument("-f", "--file",
                         help="Input probe file",
                         type=argparse.FileType('r'),
-                        required=True)
+                        required=False)
     parser.add_argument("-o", "--output_dir",
                         help="Location in which to write the output files",
                         type=str,
@@ -25,7 +55,7 @@ def get_args():
     parser.add_argument("-gdb", "--genome_database",
                         help="Reference genome database",
                         type=str,
-                        required=True)
+                        required=False)
     parser.add_argument("-vdb", "--virus_database",
                         help="Locally held Viruse reference database",
                         type=str,
@@ -41,7 +71,39 @@ def get_args():
                              "results returned by the BLAST run",
                         type=float,
                         required=False)
-    return parser.parse_args()
+    parser.add_argument("-b", "--batch_size",
+                        help="Number of records to submit to each tblastn invocation",
+                        type=int,
+                        required=False)
+    parser.add_argument("-j", "--jobs",
+                        help="Number of BLAST or scaffold merging processes to run concurrently",
+                        type=int,
+                        required=False)
+    parser.add_argument("-sp", "--single_pass",
+                        help="Merge the probe blaster results in a single pass per scaffold",
+                        action="store_true")
+    parser.add_argument("-ki", "--keep_intermediate",
+                        help="Write the per-probe tblastn results to disk for probe finder to read back",
+                        action="store_true")
+    parser.add_argument("-nu", "--no_update",
+                        help="Use the local virus database as it is, without checking the server for updates",
+                        action="store_true")
+    parser.add_argument("-p", "--pipeline",
+                        help="Start blasting merged scaffolds against the virus database while probe finder "
+                             "is still merging the rest",
+                        action="store_true")
+    parser.add_argument("-c", "--compression",
+                        help="Compress the probe finder output with gzip, or with bgzip for indexable output",
+                        choices=OUTPUT_COMPRESSIONS,
+                        required=False)
+    parser.add_argument("-r", "--resume",
+                        help="Timestamp of an interrupted run to resume, skipping the work it had finished",
+                        type=str,
+                        required=False)
+    args = parser.parse_args()
+    if not args.resume and (args.file is None or args.genome_database is None):
+        parser.error("the following arguments are required unless resuming: -f/--file, -gdb/--genome_database")
+    return args
 
 
 def write_summary_file(probe_count, fasta_count, virus_to_counts, output_dir, run_ts):
@@ -56,19 +118,233 @@ def write_summary_file(probe_count, fasta_count, virus_to_counts, output_dir, ru
             summary.write(f"{tab_char}{virus_name}: {count}\n")
 
 
+def stream_probe_hits(probe_results, hit_counts):
+    for _, filtered_results in probe_results:
+        hit_counts.append(len(filtered_results))
+        # Sorted the same way as the intermediate files so probe finder sees the records in the same order
+        yield sorted(filtered_results)
+
+
+def run_args_to_dict(args):
+    run_args = vars(args).copy()
+    run_args.pop("resume")
+    # Resolved, so that a run can be resumed from another working directory
+    run_args["file"] = str(Path(args.file.name).resolve())
+    run_args["output_dir"] = str(Path(args.output_dir).resolve())
+    return run_args
+
+
+def record_probe_hits(unit_log, hits_out, index, filtered_results):
+    # Flushed before the unit is logged, so a logged offset always points at complete hits
+    offset = None
+    if filtered_results:
+        offset = append_probe_store(hits_out, filtered_results)
+        hits_out.flush()
+    unit_log.record(index, offset=offset)
+
+
+def recorded_probe_hits(hits_path, unit):
+    if unit["offset"] is None:
+        return []
+    return list(read_probe_store(hits_path, offset=unit["offset"]))
+
+
+def checkpointed_probe_results(checkpoint, run_args):
+    # Probes finished before the run was interrupted are read back from their recorded hits
+    hits_path = checkpoint.unit_data_path(PROBE_BLASTER_STAGE, PROBE_STORE_SUFFIX)
+    completed_probes = {int(index): unit for index, unit in checkpoint.completed_units(PROBE_BLASTER_STAGE).items()}
+    # Closed explicitly, as the final next() leaves the hit cache and progress bar open
+    fresh_results = blast_probes(run_args.file,
+                                 run_args.genome_database,
+                                 run_args.alignment_len_threshold,
+                                 run_args.e_value,
+                                 batch_size=run_args.batch_size,
+                                 jobs=run_args.jobs,
+                                 skip_probes=set(completed_probes))
+    with closing(fresh_results), checkpoint.unit_log(PROBE_BLASTER_STAGE) as unit_log, \
+            open(hits_path, "ab") as hits_out:
+        for index, probe_record in enumerate(iter_fasta_file(run_args.file)):
+            if index in completed_probes:
+                yield probe_record, recorded_probe_hits(hits_path, completed_probes[index])
+            else:
+                _, filtered_results = next(fresh_results)
+                record_probe_hits(unit_log, hits_out, index, filtered_results)
+                yield probe_record, filtered_results
+    checkpoint.complete_stage(PROBE_BLASTER_STAGE)
+
+
+def run_probe_stages(checkpoint, run_args, run_ts):
+    probe_results = checkpointed_probe_results(checkpoint, run_args)
+    compression = getattr(run_args, "compression", None)
+    if run_args.keep_intermediate:
+        blasted_probes = [print_results(filtered_results, probe_record["title"], run_ts, TEMP_PROBE_BLASTER)
+                          for probe_record, filtered_results in probe_results]
+        probe_count = count_probe_records(blasted_probes)
+        probe_finder_fasta, fasta_count = run_probe_finder(blasted_probes,
+                                                           run_args.alignment_len_threshold,
+                                                           run_ts,
+                                                           single_pass=run_args.single_pass,
+                                                           jobs=run_args.jobs,
+                                                           compression=compression)
+    else:
+        hit_counts = []
+        probe_finder_fasta, fasta_count = run_probe_finder_on_records(stream_probe_hits(probe_results, hit_counts),
+                                                                      run_args.alignment_len_threshold,
+                                                                      run_ts,
+                                                                      single_pass=run_args.single_pass,
+                                                                      jobs=run_args.jobs,
+                                                                      compression=compression)
+        probe_count = sum(hit_counts)
+    checkpoint.complete_stage(PROBE_FINDER_STAGE,
+                              probe_finder_fasta=str(probe_finder_fasta),
+                              probe_count=probe_count,
+                              fasta_count=fasta_count)
+
+
+def remove_virus_blaster_outputs(output_dir, run_ts):
+    # The per-virus files are appended to, so a resumed stage rewrites them from the start
+    for virus_file in Path(output_dir).glob(f"*_{run_ts}.fasta"):
+        virus_file.unlink()
+
+
+def completed_virus_hits(checkpoint):
+    return {int(index): unit["top_hit"] for index, unit in checkpoint.completed_units(VIRUS_BLASTER_STAGE).items()}
+
+
+def run_virus_stage(checkpoint, run_args, run_ts, probe_finder_fasta):
+    completed_hits = completed_virus_hits(checkpoint)
+    remove_virus_blaster_outputs(run_args.output_dir, run_ts)
+    with checkpoint.unit_log(VIRUS_BLASTER_STAGE) as unit_log:
+        _, virus_to_counts = run_virus_blaster(probe_finder_fasta,
+                                               run_args.virus_database,
+                                               run_args.output_dir,
+                                               run_ts,
+                                               batch_size=run_args.batch_size,
+                                               jobs=run_args.jobs,
+                                               no_update=run_args.no_update,
+                                               completed_hits=completed_hits,
+                                               unit_log=unit_log)
+    checkpoint.complete_stage(VIRUS_BLASTER_STAGE, virus_to_counts=virus_to_counts)
+
+
+def scaffold_fasta_records(merged_records):
+    fasta_records = []
+    for record in sorted(merged_records):
+        title, seq = record.to_fasta().splitlines()
+        fasta_records.append({"title": title, "seq": seq})
+    return fasta_records
+
+
+def until_stopped(items, stop_merging):
+    for item in items:
+        if stop_merging.is_set():
+            return
+        yield item
+
+
+def merge_into_queue(checkpoint, run_args, run_ts, scaffold_queue, outcome, stop_merging):
+    # Runs on the merging thread; outcome holds the probe finder results or the exception that stopped it
+    try:
+        hit_counts = []
+        probe_hits = stream_probe_hits(checkpointed_probe_results(checkpoint, run_args), hit_counts)
+        record_groups = until_stopped(probe_hits, stop_merging)
+        result = {}
+        for scaffold, merged_records in iter_merged_scaffolds(record_groups,
+                                                              run_args.alignment_len_threshold,
+                                                              single_pass=run_args.single_pass,
+                                                              jobs=run_args.jobs):
+            if stop_merging.is_set():
+                return
+            result[scaffold] = merged_records
+            scaffold_queue.put(scaffold_fasta_records(merged_records))
+        probe_finder_fasta, fasta_count = write_probe_finder_results(result, run_ts,
+                                                                     getattr(run_args, "compression", None))
+        outcome.update(probe_finder_fasta=str(probe_finder_fasta), probe_count=sum(hit_counts),
+                       fasta_count=fasta_count)
+    except BaseException as error:
+        outcome["error"] = error
+    finally:
+        scaffold_queue.put(None)
+
+
+def drain_scaffold_queue(scaffold_queue):
+    while True:
+        fasta_records = scaffold_queue.get()
+        if fasta_records is None:
+            return
+        yield from fasta_records
+
+
+def run_pipelined_stages(checkpoint, run_args, run_ts):
+    # Scaffolds come out in the same order on every run, so virus hits are recorded by queue position
+    completed_hits = completed_virus_hits(checkpoint)
+    ensure_virus_db_current(run_args.no_update)
+    remove_virus_blaster_outputs(run_args.output_dir, run_ts)
+    scaffold_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    outcome = {}
+    stop_merging = threading.Event()
+    merger = threading.Thread(target=merge_into_queue,
+                              args=(checkpoint, run_args, run_ts, scaffold_queue, outcome, stop_merging),
+                              name="probe-finder",
+                              daemon=True)
+    merger.start()
+    try:
+        with checkpoint.unit_log(VIRUS_BLASTER_STAGE) as unit_log:
+            _, virus_to_counts = run_virus_blaster_on_records(drain_scaffold_queue(scaffold_queue),
+                                                              run_args.virus_database,
+                                                              run_args.output_dir,
+                                                              run_ts,
+                                                              batch_size=run_args.batch_size,
+                                                              jobs=run_args.jobs,
+                                                              completed_hits=completed_hits,
+                                                              unit_log=unit_log)
+    except BaseException:
+        # Drained so the merger is never left blocked on a full queue
+        stop_merging.set()
+        while merger.is_alive():
+            try:
+                scaffold_queue.get(timeout=PIPELINE_DRAIN_INTERVAL)
+            except queue.Empty:
+                pass
+        raise
+    merger.join()
+    if "error" in outcome:
+        raise outcome.pop("error")
+    checkpoint.complete_stage(PROBE_FINDER_STAGE, **outcome)
+    checkpoint.complete_stage(VIRUS_BLASTER_STAGE, virus_to_counts=virus_to_counts)
+
+
+def probe_finder_output_exists(checkpoint):
+    if not checkpoint.is_complete(PROBE_FINDER_STAGE):
+        return False
+    return Path(checkpoint.stage_outputs(PROBE_FINDER_STAGE)["probe_finder_fasta"]).exists()
+
+
 def run():
     args = get_args()
-    run_ts = format_timestamp_for_filename()
-    blasted_probes, probe_count = run_probe_blaster(args.file.name,
-                                                    args.genome_database,
-                                                    args.alignment_len_threshold,
-                                                    args.e_value,
-                                                    run_ts)
-    probe_finder_fasta, fasta_count = run_probe_finder(blasted_probes,
-                                                       args.alignment_len_threshold,
-                                                       run_ts)
-    _, virus_to_counts = run_virus_blaster(probe_finder_fasta,
-                                           args.virus_database,
-                                           args.output_dir,
-                                           run_ts)
-    write_summary_file(probe_count, fasta_count, virus_to_counts, args.output_dir, run_ts)
+    if args.resume:
+        checkpoint = RunCheckpoint.load(args.resume)
+        LOGGER.info(f"Resuming run {args.resume}")
+    else:
+        checkpoint = RunCheckpoint.create(format_timestamp_for_filename(), run_args_to_dict(args))
+    run_ts = checkpoint.run_ts
+    run_args = argparse.Namespace(**checkpoint.run_args)
+    if not checkpoint.is_complete(VIRUS_BLASTER_STAGE):
+        if probe_finder_output_exists(checkpoint):
+            run_virus_stage(checkpoint, run_args, run_ts,
+                            checkpoint.stage_outputs(PROBE_FINDER_STAGE)["probe_finder_fasta"])
+        else:
+            # Probe finder output is the same on every run over the same hits, so recorded virus hits still hold
+            if getattr(run_args, "pipeline", False):
+                run_pipelined_stages(checkpoint, run_args, run_ts)
+            else:
+                run_probe_stages(checkpoint, run_args, run_ts)
+                run_virus_stage(checkpoint, run_args, run_ts,
+                                checkpoint.stage_outputs(PROBE_FINDER_STAGE)["probe_finder_fasta"])
+    probe_finder_outputs = checkpoint.stage_outputs(PROBE_FINDER_STAGE)
+    write_summary_file(probe_finder_outputs["probe_count"],
+                       probe_finder_outputs["fasta_count"],
+                       checkpoint.stage_outputs(VIRUS_BLASTER_STAGE)["virus_to_counts"],
+                       run_args.output_dir,
+                       run_ts)
+    checkpoint.discard()
@@ -2,6 +2,9 @@ from .exceptions import ArgNotSupportedError
 from .templates.config_template import CONFIG_TEMPLATE
 
 from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from functools import lru_cache
 from pathlib import Path
 
@@ -15,12 +18,14 @@ TEMP_PROBE_BLASTER = "/tmp/probe_blaster"
 TEMP_PROBE_FINDER = "/tmp/probe_finder"
 TEMP_VIRUS_BLASTER = "/tmp/virus_blaster"
 DEFAULT_OUTPUT_DIR = Path.cwd() / "OUTPUT"
-TEMP_FASTA_FILE = "/tmp/temp.fasta"
-TEMP_TBLASTN_OUTPUT = "/tmp/temp_tblastn.tsv"
 NEWLINE = "\n"
 VIRUS_DB_SERVER = "ftp.ncbi.nlm.nih.gov"
 VIRUS_DB_SERVER_DIR = "refseq/release/viral/"
+VIRUS_DB_SERVER_PORT = 21
 MAKE_BLASTDB_CMD = "makeblastdb -in '{db_files}' -title {db_name} -out {out_path} -dbtype nucl"
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+# Used for both gzip and bgzip files, either of which can be read back with the gzip module
+GZIP_SUFFIX = ".gz"
 # Gives us a handle to the ERViN home directory to access things like config files
 # ERVIN_DIR = Path(__file__).parent.parent
 CONFIG_PATH = Path.home() / ".ervin/config.json"
@@ -35,7 +40,13 @@ SUPPORTED_CONFIG_ARGS = [
     "range_size",
     "probe_blaster_align_len_thresh",
     "probe_blaster_e_value_thresh",
-    "log_location"
+    "log_location",
+    "virus_db_pipe_to_makeblastdb",
+    "virus_db_check_ttl",
+    "virus_hit_cache_size",
+    "probe_hit_cache_size",
+    "blast_concurrency",
+    "blast_timeout"
 ]
 
 LOGGER = logging.getLogger(Path(__file__).stem)
@@ -46,12 +57,16 @@ def decompress_gz_file(filepath):
     LOGGER.info(f"Extracting {filepath} to {dest_file}")
     with gzip.GzipFile(filepath, "rb") as archive:
         with open(dest_file, "wb") as extracted:
-            extracted.write(archive.read())
+            shutil.copyfileobj(archive, extracted, DECOMPRESS_CHUNK_SIZE)
     return str(dest_file)
 
 
-def decompress_gz_files(file_list):
-    return [decompress_gz_file(filepath) for filepath in file_list]
+def stream_gz_files(file_list, destination):
+    # Writes the decompressed contents of each file, in order, into an open binary stream
+    for filepath in file_list:
+        LOGGER.info(f"Streaming {filepath}")
+        with gzip.GzipFile(filepath, "rb") as archive:
+            shutil.copyfileobj(archive, destination, DECOMPRESS_CHUNK_SIZE)
 
 
 def homify_path(path_string):
@@ -96,7 +111,8 @@ def get_config():
         config_data = json.load(config_in)
         for directory in REQUIRED_DIRS:
             dir_path = Path(homify_path(config_data[directory]))
-            if not dir_path.exists():
+            # A dangling virus db store link is replaced on update
+            if not dir_path.exists() and not dir_path.is_symlink():
                 dir_path.mkdir(parents=True)
     return make_config(config_data)
 
@@ -126,21 +142,80 @@ def read_and_sanitise_raw_data(filename):
     return purged_empty_lines_data
 
 
+def open_text_file(filename):
+    return gzip.open(filename, "rt") if str(filename).endswith(GZIP_SUFFIX) else open(filename)
+
+
+def iter_fasta_file(filename):
+    title = None
+    sequence_lines = []
+    with open_text_file(filename) as file_in:
+        for line in file_in:
+            line = line.strip()
+            if line.startswith(">"):
+                if title is not None:
+                    yield {"title": title, "seq": "".join(sequence_lines)}
+                title = line
+                sequence_lines = []
+            elif line and title is not None:
+                sequence_lines.append(line)
+    if title is not None:
+        yield {"title": title, "seq": "".join(sequence_lines)}
+
+
 def read_from_fasta_file(filename):
-    input_data = read_and_sanitise_raw_data(filename)
-    fasta_titles = [line for line in input_data if ">" in line]
-    title_indices = [input_data.index(title) for title in fasta_titles]
-    parsed_file_data = []
-    for i in range(len(title_indices)):
-        try:
-            sequence = "".join(input_data[title_indices[i]+1:title_indices[i+1]])
-            record = {"title": input_data[title_indices[i]], "seq": sequence}
-            parsed_file_data.append(record)
-        except IndexError:
-            sequence = "".join(input_data[title_indices[i] + 1:])
-            record = {"title": input_data[title_indices[i]], "seq": sequence}
-            parsed_file_data.append(record)
-    return parsed_file_data
+    return list(iter_fasta_file(filename))
+
+
+def count_fasta_records(filename):
+    with open_text_file(filename) as file_in:
+        return sum(1 for line in file_in if line.lstrip().startswith(">"))
+
+
+def batch_records(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def imap_batches(function, batches, workers, on_complete=None):
+    # Yields (batch, result) pairs in input order, with at most two batches per worker in flight
+    batches = iter(batches)
+    submitted = {}
+    unreported = {}
+    next_to_submit = next_to_yield = 0
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while not exhausted and next_to_submit - next_to_yield < workers * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    future = executor.submit(function, batch)
+                    submitted[next_to_submit] = (batch, future)
+                    unreported[future] = batch
+                    next_to_submit += 1
+            if next_to_yield == next_to_submit:
+                return
+            done, _ = wait(unreported, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = unreported.pop(future)
+                if on_complete is not None:
+                    on_complete(batch)
+            while next_to_yield in submitted and submitted[next_to_yield][1] not in unreported:
+                batch, future = submitted.pop(next_to_yield)
+                next_to_yield += 1
+                yield batch, future.result()
+
+
+def format_fasta_records(fasta_list):
+    return "".join(f"{fasta_record['title']}{NEWLINE}{fasta_record['seq']}{NEWLINE}" for fasta_record in fasta_list)
 
 
 def print_to_fasta_file(filename, fasta_list, mode='w'):
@@ -154,9 +229,16 @@ def print_to_fasta_file(filename, fasta_list, mode='w'):
             fasta_out.write(f"{fasta_record['title']}{NEWLINE}{fasta_record['seq']}{NEWLINE}")
 
 
+def count_lines(filepath):
+    line_count = 0
+    last_byte = NEWLINE.encode()
+    with open(filepath, "rb") as file_in:
+        for chunk in iter(lambda: file_in.read(DECOMPRESS_CHUNK_SIZE), b""):
+            line_count += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+    # A last line without a trailing newline still counts
+    return line_count + (last_byte != NEWLINE.encode())
+
+
 def total_result_records(output_filepaths):
-    total_records = 0
-    for filepath in output_filepaths:
-        with open(filepath) as output_file:
-            total_records += len(output_file.readlines())
-    return total_records
+    return sum(count_lines(filepath) for filepath in output_filepaths)
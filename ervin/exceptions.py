@@ -12,3 +12,23 @@ class InvalidPathException(Exception):
 
 class ArgNotSupportedError(Exception):
     pass
+
+
+class FastaFormatException(Exception):
+    pass
+
+
+class IncompleteDownloadException(Exception):
+    pass
+
+
+class RunNotFoundException(Exception):
+    pass
+
+
+class BlastTimeoutException(Exception):
+    pass
+
+
+class InvalidProbeStoreException(Exception):
+    pass
@@ -0,0 +1,132 @@
+from .exceptions import FastaFormatException
+
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+import logging
+import mmap
+
+FAI_SUFFIX = ".fai"
+
+# The columns of a samtools .fai index
+FaiEntry = namedtuple("FaiEntry", "length offset line_bases line_width")
+
+LOGGER = logging.getLogger(Path(__file__).stem)
+
+
+def fai_path_for(fasta_path):
+    return Path(f"{fasta_path}{FAI_SUFFIX}")
+
+
+def build_fasta_index(fasta_path):
+    entries = {}
+    name = None
+    length = offset = line_bases = line_width = 0
+    short_line_seen = False
+    position = 0
+    with open(fasta_path, "rb") as fasta_in:
+        for line in fasta_in:
+            line_start = position
+            position += len(line)
+            if line.startswith(b">"):
+                if name is not None:
+                    entries.setdefault(name, FaiEntry(length, offset, line_bases, line_width))
+                name = line[1:].split(maxsplit=1)[0].decode() if line[1:].strip() else ""
+                length = line_bases = line_width = 0
+                offset = position
+                short_line_seen = False
+                continue
+            bases = len(line.rstrip(b"\r\n"))
+            if name is None:
+                continue
+            if bases == 0:
+                short_line_seen = line_bases > 0
+                continue
+            if line_bases == 0:
+                line_bases = bases
+                line_width = len(line)
+            elif short_line_seen or bases > line_bases:
+                raise FastaFormatException(f"Inconsistent line lengths in {name} at byte {line_start} of "
+                                           f"{fasta_path}. Only the final line of a record may be shorter.")
+            if bases < line_bases:
+                short_line_seen = True
+            length += bases
+    if name is not None:
+        entries.setdefault(name, FaiEntry(length, offset, line_bases, line_width))
+    return entries
+
+
+def write_fasta_index(entries, fai_path):
+    with open(fai_path, "w") as fai_out:
+        for name, entry in entries.items():
+            fai_out.write(f"{name}\t{entry.length}\t{entry.offset}\t{entry.line_bases}\t{entry.line_width}\n")
+
+
+def read_fasta_index(fai_path):
+    entries = {}
+    with open(fai_path) as fai_in:
+        for line in fai_in:
+            line_tokens = line.rstrip("\n").split("\t")
+            entries[line_tokens[0]] = FaiEntry(*[int(token) for token in line_tokens[1:5]])
+    return entries
+
+
+def load_fasta_index(fasta_path):
+    fai_path = fai_path_for(fasta_path)
+    if fai_path.exists() and fai_path.stat().st_mtime >= Path(fasta_path).stat().st_mtime:
+        return read_fasta_index(fai_path)
+    LOGGER.info(f"Building index for {fasta_path}")
+    entries = build_fasta_index(fasta_path)
+    try:
+        write_fasta_index(entries, fai_path)
+    except OSError as error:
+        LOGGER.warning(f"Unable to cache the index for {fasta_path} at {fai_path}: {error}")
+    return entries
+
+
+class FastaIndex:
+    """Random access to the sequences of a FASTA file through a cached .fai index and a memory map"""
+
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        self.entries = load_fasta_index(fasta_path)
+        self._file = open(fasta_path, "rb")
+        if Path(fasta_path).stat().st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def sequence_length(self, name):
+        return self.entries[name].length
+
+    def _byte_offset(self, entry, position):
+        return entry.offset + (position // entry.line_bases) * entry.line_width + position % entry.line_bases
+
+    def fetch(self, name, start, end):
+        # Same semantics as slicing the full sequence
+        entry = self.entries[name]
+        start, end, _ = slice(start, end).indices(entry.length)
+        if end <= start:
+            return ""
+        raw = self._map[self._byte_offset(entry, start):self._byte_offset(entry, end - 1) + 1]
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+
+@lru_cache(maxsize=None)
+def open_fasta_index(fasta_path):
+    return FastaIndex(fasta_path)
@@ -0,0 +1,156 @@
+from .exceptions import IncompleteDownloadException
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+from pathlib import Path
+
+import calendar
+import ftplib
+import ftputil
+import ftputil.session
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MLSD_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+PARTIAL_SUFFIX = ".part"
+
+RemoteFile = namedtuple("RemoteFile", "name size mtime")
+
+LOGGER = logging.getLogger(Path(__file__).stem)
+
+
+def connect_to_ftp_dir(server, directory, port=21, user="anonymous", password=""):
+    ftp_handle = ftputil.FTPHost(server, user, password,
+                                 session_factory=ftputil.session.session_factory(port=port))
+    ftp_handle.chdir(directory)
+    return ftp_handle
+
+
+class FtpConnectionPool:
+    """Hands out FTP connections to worker threads, opening new ones only when all existing ones are busy"""
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._idle = queue.Queue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @contextmanager
+    def connection(self):
+        try:
+            ftp_handle = self._idle.get_nowait()
+        except queue.Empty:
+            ftp_handle = self._connect()
+            with self._lock:
+                self._opened.append(ftp_handle)
+        try:
+            yield ftp_handle
+        except Exception:
+            # May be left mid-transfer
+            ftp_handle.close()
+            raise
+        self._idle.put(ftp_handle)
+
+    def close(self):
+        with self._lock:
+            for ftp_handle in self._opened:
+                ftp_handle.close()
+            self._opened = []
+
+
+def list_remote_files(ftp_handle):
+    remote_files = []
+    for name in ftp_handle.listdir(ftp_handle.curdir):
+        file_stat = ftp_handle.stat(name)
+        remote_files.append(RemoteFile(name, file_stat.st_size, int(file_stat.st_mtime)))
+    return remote_files
+
+
+def parse_mlsd_timestamp(timestamp):
+    # MLSD times are UTC and may carry fractional seconds, which are dropped
+    return calendar.timegm(time.strptime(timestamp[:14], MLSD_TIMESTAMP_FORMAT))
+
+
+def list_remote_files_mlsd(server, directory, port=21, user="anonymous", password=""):
+    # One MLSD round trip gives exact sizes and modification times for the whole directory
+    with ftplib.FTP() as ftp:
+        ftp.connect(server, port)
+        ftp.login(user, password)
+        ftp.cwd(directory)
+        try:
+            return [RemoteFile(name, int(facts["size"]), parse_mlsd_timestamp(facts["modify"]))
+                    for name, facts in ftp.mlsd(facts=["type", "size", "modify"])
+                    if facts.get("type") == "file"]
+        except ftplib.error_perm:
+            LOGGER.info(f"{server} does not support MLSD, falling back to LIST")
+    with connect_to_ftp_dir(server, directory, port, user, password) as ftp_handle:
+        return list_remote_files(ftp_handle)
+
+
+def is_downloaded(destination, remote_file):
+    if not destination.exists():
+        return False
+    local_stat = destination.stat()
+    return local_stat.st_size == remote_file.size and int(local_stat.st_mtime) == remote_file.mtime
+
+
+def partial_download_path(destination, remote_file):
+    # The remote mtime is part of the name, so a partial download is never resumed against a newer file
+    return destination.with_name(f"{destination.name}.{remote_file.mtime}{PARTIAL_SUFFIX}")
+
+
+def download_file(ftp_handle, remote_file, destination):
+    destination = Path(destination)
+    if is_downloaded(destination, remote_file):
+        LOGGER.info(f"{destination} is already up to date")
+        return destination
+    partial_path = partial_download_path(destination, remote_file)
+    for stale_partial in destination.parent.glob(f"{destination.name}.*{PARTIAL_SUFFIX}"):
+        if stale_partial != partial_path:
+            stale_partial.unlink()
+    offset = partial_path.stat().st_size if partial_path.exists() else 0
+    if offset > remote_file.size:
+        partial_path.unlink()
+        offset = 0
+    with open(partial_path, "ab") as local_file:
+        if offset < remote_file.size:
+            LOGGER.info(f"Downloading {remote_file.name} to {destination} from byte {offset}")
+            with ftp_handle.open(remote_file.name, "rb", rest=offset if offset else None) as remote:
+                shutil.copyfileobj(remote, local_file, DOWNLOAD_CHUNK_SIZE)
+    downloaded_size = partial_path.stat().st_size
+    if downloaded_size != remote_file.size:
+        raise IncompleteDownloadException(f"Downloaded {downloaded_size} of {remote_file.size} bytes "
+                                          f"of {remote_file.name}")
+    os.replace(partial_path, destination)
+    os.utime(destination, (remote_file.mtime, remote_file.mtime))
+    return destination
+
+
+def download_files(connect, remote_files, destination_dir, connections, on_complete=None):
+    destination_dir = Path(destination_dir)
+
+    def download_with_pooled_connection(remote_file):
+        with pool.connection() as ftp_handle:
+            return download_file(ftp_handle, remote_file, destination_dir / remote_file.name)
+
+    with FtpConnectionPool(connect) as pool, ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = {executor.submit(download_with_pooled_connection, remote_file): remote_file
+                   for remote_file in remote_files}
+        for future in as_completed(futures):
+            future.result()
+            if on_complete is not None:
+                on_complete(futures[future])
+    return [destination_dir / remote_file.name for remote_file in remote_files]
@@ -1,18 +1,32 @@
 from .ervin_utils import DEFAULT_OUTPUT_DIR
-from .ervin_utils import TEMP_FASTA_FILE
 from .ervin_utils import TEMP_PROBE_BLASTER
-from .ervin_utils import TEMP_TBLASTN_OUTPUT
+from .ervin_utils import batch_records
+from .ervin_utils import count_fasta_records
 from .ervin_utils import get_config
+from .ervin_utils import format_fasta_records
 from .ervin_utils import format_timestamp_for_filename
-from .ervin_utils import read_from_fasta_file
+from .ervin_utils import homify_path
+from .ervin_utils import imap_batches
+from .ervin_utils import iter_fasta_file
 from .ervin_utils import total_result_records
 
+from .blast_cache import ProbeHitCache
+from .blast_cache import genome_db_identity
+
+from .blast_runner import run_blast_program
+
 from .exceptions import InvalidPathException
 
-from .probe_data import ProbeData
+from .probe_store import PROBE_STORE_SUFFIX
+from .probe_store import count_probe_records
+from .probe_store import write_probe_store
+
+from .probe_table import ProbeTable
 
-from Bio.Blast.Applications import NcbiblastnCommandline
 from collections import namedtuple
+from contextlib import nullcontext
+from functools import partial
+from pathlib import Path
 
 import argparse
 import os
@@ -21,6 +35,10 @@ import progressbar
 
 DEFAULT_ALIGNMENT_LENGTH_THRESHOLD = 400
 DEFAULT_E_VALUE_THRESHOLD = 0.009
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_JOBS = 1
+PROBE_HIT_CACHE_FILE = "probe_hits.sqlite"
+DEFAULT_PROBE_HIT_CACHE_SIZE = 100000
 
 Args = namedtuple("Args", "filename output_dir alignment_len_threshold e_value")
 
@@ -53,34 +71,89 @@ def parse_args():
                         type=float,
                         required=False,
                         default=DEFAULT_E_VALUE_THRESHOLD)
+    parser.add_argument("-b", "--batch_size",
+                        help="Number of probes to submit to each tblastn invocation",
+                        type=int,
+                        required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("-j", "--jobs",
+                        help="Number of tblastn processes to run concurrently",
+                        type=int,
+                        required=False,
+                        default=DEFAULT_JOBS)
+    parser.add_argument("-t", "--tsv",
+                        help="Write the results as tab-separated text rather than binary probe hit stores",
+                        action="store_true")
     return parser.parse_args()
 
 
-def print_probe_to_temp_fasta_file(probe):
-    with open(TEMP_FASTA_FILE, 'w') as fasta_outfile:
-        fasta_outfile.write(f"{probe['title']}\n{probe['seq']}\n")
+def probe_query_id(probe):
+    # The first word of the fasta title, which each of the probe's hits carries as its accession id
+    title_words = probe["title"].lstrip(">").split()
+    return title_words[0] if title_words else ""
+
 
+def parse_hit_line(line):
+    query_id, hit = line.strip().split("\t", 1)
+    return int(query_id[1:]), hit
 
-def run_blast(probe, db, e_value_threshold):
+
+def run_blast_batch_lines(probes, db, e_value_threshold):
+    config = get_config()
+    # Queries are renamed by position, as tblastn rewrites some titles in the qseqid
+    queries = [{"title": f">q{index}", "seq": probe["seq"]} for index, probe in enumerate(probes)]
+    query_ids = [probe_query_id(probe) for probe in probes]
+    probe_lines = [[] for _ in probes]
+    # The queries go in on stdin and the hits are grouped as tblastn streams them out, so nothing touches disk
+    for index, hit in run_blast_program("tblastn",
+                                        query=format_fasta_records(queries),
+                                        parse_line=parse_hit_line,
+                                        outfmt="6 qseqid sseqid slen sstart send evalue length qseq sseq sframe",
+                                        db=homify_path(f"{config.genome_db_storage}{db}"),
+                                        evalue=e_value_threshold):
+        probe_lines[index].append(f"{query_ids[index]}\t{hit}")
+    return probe_lines
+
+
+def run_cached_blast_batch_lines(probes, db, e_value_threshold, cache=None):
+    if cache is None:
+        return run_blast_batch_lines(probes, db, e_value_threshold)
+    probe_lines = cache.get_many(probes)
+    uncached = [index for index, lines in enumerate(probe_lines) if lines is None]
+    if uncached:
+        blasted_lines = run_blast_batch_lines([probes[index] for index in uncached], db, e_value_threshold)
+        for index, lines in zip(uncached, blasted_lines):
+            probe_lines[index] = lines
+        cache.put_many([probes[index] for index in uncached], blasted_lines)
+    return probe_lines
+
+
+def hit_table(lines):
+    table = ProbeTable()
+    for line in lines:
+        table.append_tsv_line(line)
+    return table
+
+
+def run_blast_batch(probes, db, e_value_threshold, cache=None):
+    # Hits stay in columns until filtering, so only those that pass become ProbeData objects
+    return [hit_table(lines) for lines in run_cached_blast_batch_lines(probes, db, e_value_threshold, cache)]
+
+
+def open_probe_hit_cache(db, e_value_threshold):
     config = get_config()
-    print_probe_to_temp_fasta_file(probe)
-    command = NcbiblastnCommandline(cmd="tblastn",
-                                    out=TEMP_TBLASTN_OUTPUT,
-                                    outfmt="\"6 qseqid sseqid slen sstart send "
-                                           "evalue length qseq sseq sframe\"",
-                                    query=TEMP_FASTA_FILE,
-                                    db=f"{config.genome_db_storage}{db}",
-                                    evalue=e_value_threshold)
-    command()
-    probe_records = []
-    with open(TEMP_TBLASTN_OUTPUT) as blast_output:
-        for line in blast_output:
-            probe_records.append(ProbeData(line.strip()))
-    return probe_records
-
-
-def _length_requirement(probe_list, args):
-    return [probe for probe in probe_list if probe.alignment_length > args.alignment_len_threshold]
+    max_entries = config.probe_hit_cache_size
+    if max_entries is None:
+        max_entries = DEFAULT_PROBE_HIT_CACHE_SIZE
+    if max_entries <= 0:
+        return nullcontext()
+    cache_path = Path(homify_path(config.operational_data_storage)) / PROBE_HIT_CACHE_FILE
+    db_identity = genome_db_identity(homify_path(f"{config.genome_db_storage}{db}"))
+    return ProbeHitCache(cache_path, db_identity, e_value_threshold, max_entries)
+
+
+def _length_requirement(hits, args):
+    return hits.above_alignment_length(args.alignment_len_threshold)
 
 
 def filter_results(hits, args):
@@ -89,17 +162,21 @@ def filter_results(hits, args):
     ]
     for filter_case in filters:
         hits = filter_case(hits, args)
-    return hits
+    return list(hits)
 
 
-def print_results(result_list, title, run_time, output_dir=DEFAULT_OUTPUT_DIR):
+def print_results(result_list, title, run_time, output_dir=DEFAULT_OUTPUT_DIR, export_tsv=False):
+    # Results go to a binary probe hit store unless TSV is asked for, as probe_finder reads either
     if not os.path.isdir(output_dir):
         if os.path.exists(output_dir):
             raise InvalidPathException(f"Invalid output path provided: {output_dir}")
         else:
             os.makedirs(output_dir)
-    output_filename = f"{title.replace('>', '')}_{run_time}.tsv"
+    output_suffix = ".tsv" if export_tsv else PROBE_STORE_SUFFIX
+    output_filename = f"{title.replace('>', '')}_{run_time}{output_suffix}"
     output_filepath = os.path.join(output_dir, output_filename)
+    if not export_tsv:
+        return write_probe_store(output_filepath, sorted(result_list))
     with open(output_filepath, 'w') as result_out:
         for result in sorted(result_list):
             result_out.write(result.to_tsv())
@@ -107,28 +184,53 @@ def print_results(result_list, title, run_time, output_dir=DEFAULT_OUTPUT_DIR):
     return output_filepath
 
 
-def run_probe_blaster(file, genome_db, align_threshold, e_value, run_ts=None, output_dir=TEMP_PROBE_BLASTER):
-    run_time = run_ts if run_ts else format_timestamp_for_filename()
+def blast_probes(file, genome_db, align_threshold, e_value, batch_size=None, jobs=None, skip_probes=None):
     align_len = align_threshold if align_threshold else DEFAULT_ALIGNMENT_LENGTH_THRESHOLD
     e_val_threshold = e_value if e_value else DEFAULT_E_VALUE_THRESHOLD
-    args = Args(file, output_dir, align_len, e_val_threshold)
-    probe_records = read_from_fasta_file(file)
-    output_filepaths = []
-    with progressbar.ProgressBar(max_value=len(probe_records),
-                                 type="percentage",
-                                 prefix="Blasting against Genome DB: ") as bar:
-        for count, probe_record in enumerate(probe_records):
-            bar.update(count)
-            blast_result = run_blast(probe_record, genome_db, e_val_threshold)
-            filtered_results = filter_results(blast_result, args)
-            output_file = print_results(filtered_results,
-                                        probe_record["title"],
-                                        run_time, output_dir)
-            output_filepaths.append(output_file)
-    return output_filepaths, total_result_records(output_filepaths)
+    probes_per_batch = batch_size if batch_size else DEFAULT_BATCH_SIZE
+    worker_count = jobs if jobs else DEFAULT_JOBS
+    args = Args(file, None, align_len, e_val_threshold)
+    # Load the config up front so that worker threads don't race to create it
+    get_config()
+    completed_probes = 0
+    with open_probe_hit_cache(genome_db, e_val_threshold) as probe_hit_cache, \
+            progressbar.ProgressBar(max_value=count_fasta_records(file) - len(skip_probes or []),
+                                    type="percentage",
+                                    prefix="Blasting against Genome DB: ") as bar:
+
+        def update_progress(batch):
+            nonlocal completed_probes
+            completed_probes += len(batch)
+            bar.update(completed_probes)
+
+        # Only the raw hits are cached, so the alignment length filter is always applied afresh
+        run_batch = partial(run_blast_batch, db=genome_db, e_value_threshold=e_val_threshold,
+                            cache=probe_hit_cache)
+        probe_records = iter_fasta_file(file)
+        if skip_probes:
+            # Probes are skipped by their position in the file, as titles need not be unique
+            probe_records = (probe_record for index, probe_record in enumerate(probe_records)
+                             if index not in skip_probes)
+        batches = batch_records(probe_records, probes_per_batch)
+        for batch, blast_results in imap_batches(run_batch, batches, worker_count, update_progress):
+            for probe_record, blast_result in zip(batch, blast_results):
+                yield probe_record, filter_results(blast_result, args)
+
+
+def run_probe_blaster(file, genome_db, align_threshold, e_value, run_ts=None, output_dir=TEMP_PROBE_BLASTER,
+                      batch_size=None, jobs=None, export_tsv=False):
+    run_time = run_ts if run_ts else format_timestamp_for_filename()
+    output_filepaths = [
+        print_results(filtered_results, probe_record["title"], run_time, output_dir, export_tsv)
+        for probe_record, filtered_results in blast_probes(file, genome_db, align_threshold, e_value,
+                                                           batch_size, jobs)
+    ]
+    count_records = total_result_records if export_tsv else count_probe_records
+    return output_filepaths, count_records(output_filepaths)
 
 
 if __name__ == "__main__":
     args = parse_args()
     run_probe_blaster(args.file.name, args.genome_database, args.alignment_len_threshold,
-                      args.e_value, args.output_dir)
+                      args.e_value, output_dir=args.output_dir or TEMP_PROBE_BLASTER,
+                      batch_size=args.batch_size, jobs=args.jobs, export_tsv=args.tsv)
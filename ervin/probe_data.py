@@ -1,17 +1,72 @@
 from math import ceil
 
+import sys
+
+GAP = "-"
+
+
+# Merged alignments are ropes of (length, gap count, text) leaves and (length, gap count, left, right) joins
+
+
+def alignment_node(alignment):
+    if isinstance(alignment, str):
+        return len(alignment), alignment.count(GAP), alignment
+    return alignment
+
+
+def join_alignments(left, right):
+    if not left[0]:
+        return right
+    if not right[0]:
+        return left
+    return left[0] + right[0], left[1] + right[1], left, right
+
+
+def drop_alignment_prefix(node, count):
+    # Walks down the left spine to the piece where the kept part begins, then rebuilds the joins above it
+    right_siblings = []
+    while len(node) == 4 and count > 0:
+        left, right = node[2], node[3]
+        if count >= left[0]:
+            count -= left[0]
+            node = right
+        else:
+            right_siblings.append(right)
+            node = left
+    if count > 0:
+        node = alignment_node(node[2][count:])
+    for right in reversed(right_siblings):
+        node = join_alignments(node, right)
+    return node
+
+
+def alignment_text(node):
+    pieces = []
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        if len(node) == 4:
+            pending.append(node[3])
+            pending.append(node[2])
+        else:
+            pieces.append(node[2])
+    return "".join(pieces)
+
 
 class ProbeData:
-    accession_id = str
-    scaffold = str
-    scaffold_length = int
-    start = int
-    end = int
-    e_value = str
-    alignment_length = int
-    acc_sequence = str
-    scaffold_alignment = str
-    frame = int
+    __slots__ = ("accession_id", "scaffold", "scaffold_length", "start", "end", "e_value", "alignment_length",
+                 "acc_sequence", "_alignment", "frame", "direction", "matched", "printed")
+    accession_id: str
+    scaffold: str
+    scaffold_length: int
+    start: int
+    end: int
+    e_value: str
+    alignment_length: int
+    acc_sequence: str
+    scaffold_alignment: str
+    frame: int
+    direction: str
 
     def __init__(self, source=None, overrides=None):
         if isinstance(source, ProbeData):
@@ -21,7 +76,7 @@ class ProbeData:
             self.e_value = source.e_value
             self.alignment_length = source.alignment_length
             self.acc_sequence = source.acc_sequence
-            self.scaffold_alignment = source.scaffold_alignment
+            self._alignment = source._alignment
             self.frame = source.frame
             self.start = source.start
             self.end = source.end
@@ -34,8 +89,9 @@ class ProbeData:
 
         elif source is not None:
             line_tokens = source.strip().split("\t")
-            self.accession_id = line_tokens[0]
-            self.scaffold = line_tokens[1]
+            # Interned as the same few accessions and scaffolds recur across many thousands of hits
+            self.accession_id = sys.intern(line_tokens[0])
+            self.scaffold = sys.intern(line_tokens[1])
             self.scaffold_length = int(line_tokens[2])
             self.e_value = line_tokens[5]
             self.alignment_length = int(line_tokens[6])
@@ -55,6 +111,19 @@ class ProbeData:
                 self.end = first_position
                 self.direction = "N"
 
+    @property
+    def scaffold_alignment(self):
+        # Merged records build their alignment text only once something asks for it
+        if isinstance(self._alignment, str):
+            return self._alignment
+        if len(self._alignment) == 4:
+            self._alignment = self._alignment[0], self._alignment[1], alignment_text(self._alignment)
+        return self._alignment[2]
+
+    @scaffold_alignment.setter
+    def scaffold_alignment(self, alignment):
+        self._alignment = alignment
+
     def __hash__(self):
         return hash(repr(self))
 
@@ -129,20 +198,22 @@ class ProbeData:
         else:
             first = b
             second = a
-        overrides = {
-            "start": first.start,
-            "end": second.end
-        }
+        first_alignment = alignment_node(first._alignment)
+        second_alignment = alignment_node(second._alignment)
         if first.end < second.start:
-            overrides["scaffold_alignment"] = "".join([first.scaffold_alignment,
-                                                       "-" * ceil((second.start - first.end) / 3),
-                                                       second.scaffold_alignment])
+            gap = alignment_node(GAP * ceil((second.start - first.end) / 3))
+            alignment = join_alignments(join_alignments(first_alignment, gap), second_alignment)
         elif first.end > second.start:
             overlap = ceil((first.end - second.start) / 3)
-            overrides["scaffold_alignment"] = "".join([first.scaffold_alignment,
-                                                       second.scaffold_alignment[overlap:]])
-        align_length = (overrides["end"] - overrides["start"]) - \
-                       overrides["scaffold_alignment"].count("-")
-        overrides["alignment_length"] = align_length
-        overrides["accession_id"] = first.accession_id + "_" + second.accession_id
+            alignment = join_alignments(first_alignment, drop_alignment_prefix(second_alignment, overlap))
+        else:
+            # Records that meet end to start have never had an alignment to merge
+            raise KeyError("scaffold_alignment")
+        overrides = {
+            "start": first.start,
+            "end": second.end,
+            "_alignment": alignment,
+            "alignment_length": (second.end - first.start) - alignment[1],
+            "accession_id": first.accession_id + "_" + second.accession_id
+        }
         return ProbeData(first, overrides)
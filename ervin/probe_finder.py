@@ -1,28 +1,50 @@
 from .ervin_utils import DEFAULT_OUTPUT_DIR
+from .ervin_utils import GZIP_SUFFIX
 from .ervin_utils import TEMP_PROBE_FINDER
 from .ervin_utils import format_timestamp_for_filename
-from .ervin_utils import total_result_records
+from .ervin_utils import open_text_file
 
 from .exceptions import InvalidPathException
 
 from .probe_data import ProbeData
 
+from .probe_index import ProbeIndex
+
+from .probe_store import is_probe_store
+from .probe_store import read_probe_store
+
+from .probe_table import ProbeTable
+
+from array import array
+from Bio import bgzf
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 
 import argparse
+import gzip
+import multiprocessing
 import os
 import progressbar
 
 Args = namedtuple("Args", "file_list alignment_len_threshold")
-
-
-def read_probe_records_from_file(filename):
-    record_list = []
-    with open(filename) as probe_in:
-        for line in probe_in:
-            record_list.append(ProbeData(line))
-    record_dict = {}
-    for record in record_list:
+# Scaffolds are sent to merge worker processes in chunks of roughly this many records
+MERGE_CHUNK_RECORDS = 20000
+# Below this many comparitors the NumPy set-up costs more than folding each record over every comparitor
+INDEXED_MERGE_MIN_COMPARITORS = 32
+MERGE_START_METHOD = "forkserver"
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# Records are held back and written together in batches of this many
+OUTPUT_BATCH_RECORDS = 1000
+OUTPUT_COMPRESSIONS = ["gzip", "bgzip"]
+GZIP_COMPRESS_LEVEL = 6
+
+
+def group_records_by_scaffold(records, record_dict=None):
+    if record_dict is None:
+        record_dict = {}
+    for record in records:
         if record.scaffold not in record_dict:
             record_dict[record.scaffold] = [record]
         else:
@@ -30,29 +52,89 @@ def read_probe_records_from_file(filename):
     return record_dict
 
 
-def write_to_files(output_files, record):
-    (fasta_output, tsv_output) = output_files
-    with open(fasta_output, "a") as fasta:
-        with open(tsv_output, "a") as tsv:
-            fasta.write(record.to_fasta())
-            tsv.write(record.to_tsv())
+def read_probe_records_from_file(filename, record_dict=None):
+    if is_probe_store(filename):
+        return group_records_by_scaffold(read_probe_store(filename), record_dict)
+    with open_text_file(filename) as probe_in:
+        return group_records_by_scaffold((ProbeData(line) for line in probe_in), record_dict)
+
+
+def read_probe_records_from_files(file_list):
+    record_dict = {}
+    for filename in file_list:
+        read_probe_records_from_file(filename, record_dict)
+    return record_dict
+
+
+def open_output_file(filepath, compression=None):
+    if compression == "gzip":
+        return gzip.open(filepath, "wb", compresslevel=GZIP_COMPRESS_LEVEL)
+    if compression == "bgzip":
+        return bgzf.BgzfWriter(filepath, "wb", compresslevel=GZIP_COMPRESS_LEVEL)
+    return open(filepath, "wb", buffering=OUTPUT_BUFFER_SIZE)
+
 
+class ProbeFinderWriter:
+    """Holds the fasta and tsv outputs open for a whole run, writing records to them in batches"""
 
-def set_up_output_files(output_dir, run_ts=None):
+    def __init__(self, output_files, compression=None):
+        (fasta_output, tsv_output) = output_files
+        self.record_count = 0
+        self._fasta = open_output_file(fasta_output, compression)
+        self._tsv = open_output_file(tsv_output, compression)
+        self._fasta_pending = []
+        self._tsv_pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, record):
+        self._fasta_pending.append(record.to_fasta())
+        self._tsv_pending.append(record.to_tsv())
+        self.record_count += 1
+        if len(self._tsv_pending) >= OUTPUT_BATCH_RECORDS:
+            self.flush()
+
+    def write_records(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        self._fasta.write("".join(self._fasta_pending).encode())
+        self._tsv.write("".join(self._tsv_pending).encode())
+        self._fasta_pending = []
+        self._tsv_pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._fasta.close()
+            self._tsv.close()
+
+
+def set_up_output_files(output_dir, run_ts=None, compression=None):
     if not os.path.isdir(output_dir):
         if os.path.exists(output_dir):
             raise InvalidPathException(f"Invalid output path provided: {output_dir}")
         else:
             os.makedirs(output_dir)
     run_time = run_ts if run_ts else format_timestamp_for_filename()
-    fasta_output_path = os.path.join(output_dir, f"probe_finder-{run_time}.fasta")
-    tsv_output_path = os.path.join(output_dir, f"probe_finder-{run_time}.tsv")
-    with open(fasta_output_path, "w"):
-        with open(tsv_output_path, "w"):
-            pass
+    suffix = GZIP_SUFFIX if compression else ""
+    fasta_output_path = os.path.join(output_dir, f"probe_finder-{run_time}.fasta{suffix}")
+    tsv_output_path = os.path.join(output_dir, f"probe_finder-{run_time}.tsv{suffix}")
     return fasta_output_path, tsv_output_path
 
 
+def write_probe_finder_output(output_files, result, compression=None):
+    with ProbeFinderWriter(output_files, compression) as writer:
+        writer.write_records(flatten_results(result))
+    return writer.record_count
+
+
 def unique_scaffolds(source_one, source_two):
     source_one_uniques = [
         scaffold for scaffold in source_one.keys() if scaffold not in source_two.keys()
@@ -86,57 +168,299 @@ def is_align_length_threshold_satisfied(args, record):
         return False
 
 
-def find_probes(args, first_probe_data, second_probe_data):
+def ordered_unique(records):
+    # Drops records reached more than once, keeping the first in place
+    return list(dict.fromkeys(records))
+
+
+def merge_scaffold_records_pairwise(args, records, comparitors):
+    merged_records = []
+    for record in records:
+        if is_align_length_threshold_satisfied(args, record):
+            current_print_candidate = record
+            for comparitor in comparitors:
+                if current_print_candidate.is_superset(comparitor):
+                    current_print_candidate = comparitor
+                elif current_print_candidate.is_near_neighbour(comparitor) \
+                        or current_print_candidate.is_range_extension(comparitor):
+                    current_print_candidate = ProbeData.merge_records(
+                        current_print_candidate,
+                        comparitor)
+            merged_records.append(current_print_candidate)
+    return ordered_unique(merged_records)
+
+
+def align_length_threshold_records(args, records):
+    if args.alignment_len_threshold is None:
+        return records
+    return [record for record in records if is_align_length_threshold_satisfied(args, record)]
+
+
+def merge_scaffold_records(args, records, comparitors):
+    if len(comparitors) < INDEXED_MERGE_MIN_COMPARITORS:
+        return merge_scaffold_records_pairwise(args, records, comparitors)
+    comparitor_index = ProbeIndex(comparitors)
+    return ordered_unique(comparitor_index.merge_candidates(align_length_threshold_records(args, records)))
+
+
+def record_span(record):
+    return record.start, record.end, record.frame
+
+
+def unique_spans(records):
+    # Keeps the first of any records covering the same span
+    return list({record_span(record): record for record in reversed(records)}.values())[::-1]
+
+
+def merge_scaffold_records_to_completion(args, records, comparitors):
+    # One self-merge can leave records that still merge with each other
+    merged_records = unique_spans(merge_scaffold_records(args, records, comparitors))
+    while [record_span(record) for record in merged_records] != [record_span(record) for record in records]:
+        records = merged_records
+        merged_records = unique_spans(merge_scaffold_records(args, records, records))
+    return merged_records
+
+
+def merge_executor(jobs):
+    # Scaffolds are only farmed out to worker processes when more than one job is asked for
+    if jobs is None or jobs <= 1:
+        return nullcontext()
+    # A fork server, as forking while other threads hold locks can deadlock the children
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(MERGE_START_METHOD))
+
+
+def chunk_scaffolds(scaffold_sizes):
+    # Groups (scaffold, record count) pairs into worker tasks big enough to be worth sending
+    chunk = []
+    chunk_size = 0
+    for scaffold, size in scaffold_sizes:
+        chunk.append(scaffold)
+        chunk_size += size
+        if chunk_size >= MERGE_CHUNK_RECORDS:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield chunk
+
+
+def pack_merged_records(merged_records, input_records):
+    # Unchanged records are sent back as their input position, as the parent already holds them
+    input_positions = {id(record): position for position, record in enumerate(input_records)}
+    positions = array("q")
+    created = ProbeTable()
+    for record in merged_records:
+        position = input_positions.get(id(record), -1)
+        positions.append(position)
+        if position < 0:
+            created.append(record)
+    return positions, created
+
+
+def unpack_merged_records(packed_records, input_records):
+    positions, created = packed_records
+    created_records = iter(created)
+    return [input_records[position] if position >= 0 else next(created_records) for position in positions]
+
+
+def group_merged_records(merged_records):
+    scaffold_records = {}
+    for record in merged_records:
+        scaffold_records.setdefault(record.scaffold, []).append(record)
+    return scaffold_records
+
+
+def merge_scaffold_tables(args, merge_scaffold, records_table, comparitors_table):
+    # Runs in a merge worker; a comparitor table of None stands for the records themselves
+    records = list(records_table)
+    comparitors = records if comparitors_table is None else list(comparitors_table)
+    scaffold_records = group_records_by_scaffold(records)
+    scaffold_comparitors = scaffold_records if comparitors_table is None else group_records_by_scaffold(comparitors)
+    merged_records = []
+    for scaffold, records_for_scaffold in scaffold_records.items():
+        merged_records.extend(merge_scaffold(args, records_for_scaffold, scaffold_comparitors[scaffold]))
+    return pack_merged_records(merged_records, records if comparitors_table is None else records + comparitors)
+
+
+def merge_scaffolds_in_pool(executor, args, first_probe_data, second_probe_data, merge_scaffold):
+    chunks = list(chunk_scaffolds((scaffold, len(records)) for scaffold, records in first_probe_data.items()))
+    chunk_inputs = []
+    for chunk in chunks:
+        records = [record for scaffold in chunk for record in first_probe_data[scaffold]]
+        if all(first_probe_data[scaffold] is second_probe_data[scaffold] for scaffold in chunk):
+            chunk_inputs.append((records, None))
+        else:
+            chunk_inputs.append((records, [record for scaffold in chunk for record in second_probe_data[scaffold]]))
+    merge_chunk = partial(merge_scaffold_tables, args, merge_scaffold)
+    records_tables = (ProbeTable(records) for records, _ in chunk_inputs)
+    comparitors_tables = (None if comparitors is None else ProbeTable(comparitors) for _, comparitors in chunk_inputs)
+    merged_data = {}
+    with progressbar.ProgressBar(max_value=len(first_probe_data),
+                                 type="percentage",
+                                 prefix="Filtering and merging: ") as bar:
+        # Results are gathered in scaffold order, so the output matches an in-process merge
+        packed_chunks = executor.map(merge_chunk, records_tables, comparitors_tables)
+        for chunk, (records, comparitors), packed_records in zip(chunks, chunk_inputs, packed_chunks):
+            input_records = records if comparitors is None else records + comparitors
+            merged_data.update(group_merged_records(unpack_merged_records(packed_records, input_records)))
+            bar.update(bar.value + len(chunk))
+    return merged_data
+
+
+def find_probes(args, first_probe_data, second_probe_data, merge_scaffold=merge_scaffold_records, executor=None):
     output_data = unique_scaffolds(first_probe_data, second_probe_data)
+    if executor is not None:
+        output_data.update(merge_scaffolds_in_pool(executor, args, first_probe_data, second_probe_data,
+                                                   merge_scaffold))
+        return output_data
 
     with progressbar.ProgressBar(max_value=len(first_probe_data),
                                  type="percentage",
                                  prefix="Filtering and merging: ") as bar:
         for count, (scaffold, records) in enumerate(first_probe_data.items()):
             bar.update(count)
-            for record in records:
-                if is_align_length_threshold_satisfied(args, record):
-                    current_print_candidate = record
-                    for comparitor in second_probe_data[scaffold]:
-                        if current_print_candidate.is_superset(comparitor):
-                            current_print_candidate = comparitor
-                        elif current_print_candidate.is_near_neighbour(comparitor) \
-                                or current_print_candidate.is_range_extension(comparitor):
-                            current_print_candidate = ProbeData.merge_records(
-                                current_print_candidate,
-                                comparitor)
-                    if scaffold not in output_data:
-                        output_data[scaffold] = {current_print_candidate}
-                    else:
-                        output_data[scaffold].add(current_print_candidate)
+            merged_records = merge_scaffold(args, records, second_probe_data[scaffold])
+            if merged_records:
+                output_data[scaffold] = merged_records
         return output_data
 
 
-def find_probes_recursively(file_list, args, tail=None):
-    if tail is None:
-        if len(file_list) == 1:
-            first_probe_data = read_probe_records_from_file(file_list[0])
-            second_probe_data = read_probe_records_from_file(file_list[0])
-            return find_probes(args, first_probe_data, second_probe_data)
-        elif len(file_list) == 2:
-            first_probe_data = read_probe_records_from_file(file_list[0])
-            second_probe_data = read_probe_records_from_file(file_list[1])
-            return find_probes(args, first_probe_data, second_probe_data)
-        elif len(file_list) > 2:
-            first_probe_data = read_probe_records_from_file(file_list[0])
-            second_probe_data = read_probe_records_from_file(file_list[1])
-            return find_probes_recursively(file_list[2:],
-                                           args,
-                                           tail=find_probes(args,
-                                                            first_probe_data,
-                                                            second_probe_data))
-    else:
-        if len(file_list) == 0:
-            return find_probes(args, tail, tail)
+def copy_probe_data(probe_data):
+    return {scaffold: [ProbeData(record) for record in records] for scaffold, records in probe_data.items()}
+
+
+def fold_probe_data(probe_data_sources, args, executor=None):
+    # Folds each source's scaffold-keyed records into the accumulated results one at a time
+    find = partial(find_probes, args, executor=executor)
+    probe_data_sources = iter(probe_data_sources)
+    first_probe_data = next(probe_data_sources, None)
+    if first_probe_data is None:
+        return None
+    second_probe_data = next(probe_data_sources, None)
+    if second_probe_data is None:
+        return find(first_probe_data, copy_probe_data(first_probe_data))
+    tail = find(first_probe_data, second_probe_data)
+    folded = False
+    for probe_data in probe_data_sources:
+        tail = find(tail, probe_data)
+        folded = True
+    return find(tail, tail) if folded else tail
+
+
+def fold_scaffold_records(record_lists, source_count, args, merge_scaffold=merge_scaffold_records):
+    # fold_probe_data for a single scaffold, as scaffolds never interact
+    def fold_step(first, second):
+        if first is None:
+            return second
+        if second is None:
+            return first
+        return merge_scaffold(args, first, second) or None
+
+    folded = None
+    for records in record_lists:
+        folded = fold_step(folded, records)
+    if folded is None:
+        return None
+    if source_count == 1:
+        return fold_step(folded, [ProbeData(record) for record in folded])
+    if source_count > 2:
+        return fold_step(folded, folded)
+    return folded
+
+
+def group_sources_by_scaffold(record_groups):
+    scaffold_sources = {}
+    source_count = 0
+    for records in record_groups:
+        source_count += 1
+        for scaffold, scaffold_records in group_records_by_scaffold(records).items():
+            scaffold_sources.setdefault(scaffold, []).append(scaffold_records)
+    return scaffold_sources, source_count
+
+
+def merge_scaffold_sources(args, record_lists, source_count, single_pass=False):
+    if single_pass:
+        records = [record for records in record_lists for record in records]
+        return merge_scaffold_records_to_completion(args, records, records)
+    return fold_scaffold_records(record_lists, source_count, args)
+
+
+def chunk_source_records(scaffold_sources, chunk):
+    # List n holds the nth list of records of each scaffold, leaving out sources without any
+    source_records = []
+    for scaffold in chunk:
+        for position, records in enumerate(scaffold_sources[scaffold]):
+            if position == len(source_records):
+                source_records.append([])
+            source_records[position].extend(records)
+    return source_records
+
+
+def merge_scaffold_source_tables(args, source_count, single_pass, source_tables):
+    # Runs in a merge worker, on the tables of chunk_source_records
+    source_records = [list(table) for table in source_tables]
+    scaffold_sources = {}
+    for records in source_records:
+        for scaffold, scaffold_records in group_records_by_scaffold(records).items():
+            scaffold_sources.setdefault(scaffold, []).append(scaffold_records)
+    merged_records = []
+    for record_lists in scaffold_sources.values():
+        merged_records.extend(merge_scaffold_sources(args, record_lists, source_count, single_pass) or [])
+    return pack_merged_records(merged_records, [record for records in source_records for record in records])
+
+
+def iter_pool_merged_scaffolds(executor, args, scaffold_sources, source_count, single_pass):
+    chunks = list(chunk_scaffolds((scaffold, sum(len(records) for records in record_lists))
+                                  for scaffold, record_lists in scaffold_sources.items()))
+    chunk_inputs = [chunk_source_records(scaffold_sources, chunk) for chunk in chunks]
+    source_tables = ([ProbeTable(records) for records in source_records] for source_records in chunk_inputs)
+    merge_chunk = partial(merge_scaffold_source_tables, args, source_count, single_pass)
+    for chunk, source_records, packed_records in zip(chunks, chunk_inputs, executor.map(merge_chunk, source_tables)):
+        input_records = [record for records in source_records for record in records]
+        merged_scaffolds = group_merged_records(unpack_merged_records(packed_records, input_records))
+        for scaffold in chunk:
+            yield scaffold, merged_scaffolds.get(scaffold)
+
+
+def iter_merged_scaffolds(record_groups, align_len_threshold, single_pass=False, jobs=None):
+    # Yields each scaffold's records as soon as it has been merged
+    args = Args(None, align_len_threshold)
+    scaffold_sources, source_count = group_sources_by_scaffold(record_groups)
+    with merge_executor(jobs) as executor, \
+            progressbar.ProgressBar(max_value=len(scaffold_sources),
+                                    type="percentage",
+                                    prefix="Filtering and merging: ") as bar:
+        if executor is None:
+            merged_scaffolds = ((scaffold, merge_scaffold_sources(args, record_lists, source_count, single_pass))
+                                for scaffold, record_lists in scaffold_sources.items())
         else:
-            probe_data = read_probe_records_from_file(file_list[0])
-            return find_probes_recursively(file_list[1:], args,
-                                           tail=find_probes(args, tail, probe_data))
+            merged_scaffolds = iter_pool_merged_scaffolds(executor, args, scaffold_sources, source_count,
+                                                          single_pass)
+        for count, (scaffold, merged_records) in enumerate(merged_scaffolds):
+            bar.update(count)
+            if merged_records:
+                yield scaffold, merged_records
+
+
+def find_probes_recursively(file_list, args, executor=None):
+    # Iterative despite the name, so that the number of files isn't bounded by the recursion limit
+    return fold_probe_data((read_probe_records_from_file(filename) for filename in file_list), args, executor)
+
+
+def find_probes_single_pass(file_list, args, executor=None):
+    # Each scaffold is merged against itself once every file's records are in
+    probe_data = read_probe_records_from_files(file_list)
+    return find_probes(args, probe_data, probe_data, merge_scaffold_records_to_completion, executor)
+
+
+def find_probes_in_record_groups(record_groups, args, single_pass=False, executor=None):
+    # In-process equivalent of the file based runs, taking one list of records per probe
+    if single_pass:
+        probe_data = {}
+        for records in record_groups:
+            group_records_by_scaffold(records, probe_data)
+        return find_probes(args, probe_data, probe_data, merge_scaffold_records_to_completion, executor)
+    return fold_probe_data((group_records_by_scaffold(records) for records in record_groups), args, executor)
 
 
 def read_filenames_from_manifest(manifest):
@@ -156,6 +480,17 @@ def parse_args():
                              "alignment sequence lengths should exceed",
                         type=int,
                         required=False)
+    parser.add_argument("-sp", "--single_pass",
+                        help="Merge the records from all input files in a single pass per scaffold",
+                        action="store_true")
+    parser.add_argument("-j", "--jobs",
+                        help="Number of processes to merge scaffolds across",
+                        type=int,
+                        required=False)
+    parser.add_argument("-c", "--compression",
+                        help="Compress the output files with gzip, or with bgzip for indexable output",
+                        choices=OUTPUT_COMPRESSIONS,
+                        required=False)
     file_sourcing = parser.add_mutually_exclusive_group(required=True)
     file_sourcing.add_argument("-f", "--file_list",
                                help="Input file list",
@@ -170,32 +505,44 @@ def parse_args():
 def run_as_main():
     args = parse_args()
     result = None
-    if args.file_list is not None:
-        input_files = [input_file.name for input_file in args.file_list]
-        if len(input_files) == 1:
-            raise Exception("Uneccessary run with only one file provided.")
-        elif len(input_files) > 1:
-            result = find_probes_recursively(input_files, args)
-    else:
-        file_list = read_filenames_from_manifest(args.manifest.name)
-        result = find_probes_recursively(file_list, args)
+    find_probes_in_files = find_probes_single_pass if args.single_pass else find_probes_recursively
+    with merge_executor(args.jobs) as executor:
+        if args.file_list is not None:
+            input_files = [input_file.name for input_file in args.file_list]
+            if len(input_files) == 1:
+                raise Exception("Uneccessary run with only one file provided.")
+            elif len(input_files) > 1:
+                result = find_probes_in_files(input_files, args, executor)
+        else:
+            file_list = read_filenames_from_manifest(args.manifest.name)
+            result = find_probes_in_files(file_list, args, executor)
 
     if result is not None:
-        result_data = flatten_results(result)
-        output_files = set_up_output_files(args.output_dir)
-        [write_to_files(output_files, output) for output in result_data]
+        write_probe_finder_output(set_up_output_files(args.output_dir, compression=args.compression), result,
+                                  args.compression)
     else:
         raise Exception("No results after running probe_finder.")
 
 
-def run_probe_finder(file_list, align_len_threshold, run_ts):
-    args = Args(file_list, align_len_threshold)
-    result = find_probes_recursively(file_list, args)
+def write_probe_finder_results(result, run_ts, compression=None):
+    output_files = set_up_output_files(TEMP_PROBE_FINDER, run_ts, compression)
+    return output_files[0], write_probe_finder_output(output_files, result, compression)
+
 
-    result_data = flatten_results(result)
-    output_files = set_up_output_files(TEMP_PROBE_FINDER, run_ts)
-    [write_to_files(output_files, output) for output in result_data]
-    return output_files[0], total_result_records([output_files[1]])
+def run_probe_finder(file_list, align_len_threshold, run_ts, single_pass=False, jobs=None, compression=None):
+    args = Args(file_list, align_len_threshold)
+    find_probes_in_files = find_probes_single_pass if single_pass else find_probes_recursively
+    with merge_executor(jobs) as executor:
+        result = find_probes_in_files(file_list, args, executor)
+    return write_probe_finder_results(result, run_ts, compression)
+
+
+def run_probe_finder_on_records(record_groups, align_len_threshold, run_ts, single_pass=False, jobs=None,
+                                compression=None):
+    args = Args(None, align_len_threshold)
+    with merge_executor(jobs) as executor:
+        result = find_probes_in_record_groups(record_groups, args, single_pass, executor)
+    return write_probe_finder_results(result, run_ts, compression)
 
 
 if __name__ == "__main__":
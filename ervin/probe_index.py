@@ -0,0 +1,111 @@
+from .probe_data import ProbeData
+
+from heapq import heappop
+from heapq import heappush
+
+import numpy as np
+
+# The furthest apart two records can be and still satisfy ProbeData.is_near_neighbour
+NEIGHBOUR_DISTANCE = 50
+
+
+def merge_partner_mask(starts, ends, comparitor_starts, comparitor_ends):
+    # ProbeData.is_superset, is_near_neighbour and is_range_extension over arrays sharing a frame
+    superset = (starts >= comparitor_starts) & (ends <= comparitor_ends)
+    first_diff = starts - comparitor_ends
+    second_diff = comparitor_starts - ends
+    near_neighbour = ((first_diff > 0) & (first_diff <= NEIGHBOUR_DISTANCE)) \
+        | ((second_diff > 0) & (second_diff <= NEIGHBOUR_DISTANCE))
+    range_extension = ((starts <= comparitor_starts) & (comparitor_starts <= ends) & (ends < comparitor_ends)) \
+        | ((comparitor_starts <= starts) & (starts <= comparitor_ends) & (comparitor_ends < ends)) \
+        | ((ends >= comparitor_ends) & (comparitor_starts <= starts) & (starts < comparitor_ends)) \
+        | ((comparitor_ends >= ends) & (starts <= comparitor_starts) & (comparitor_starts < ends))
+    return superset | near_neighbour | range_extension
+
+
+def record_arrays(records):
+    return tuple(np.fromiter((getattr(record, field) for record in records), dtype=np.int64, count=len(records))
+                 for field in ("start", "end", "frame"))
+
+
+class ProbeIndex:
+    """Start-sorted arrays over the comparitor records of a single scaffold, partitioned by frame"""
+
+    def __init__(self, records):
+        self.records = list(records)
+        self.starts, self.ends, frames = record_arrays(self.records)
+        self.frames = {}
+        for frame in np.unique(frames):
+            positions = np.flatnonzero(frames == frame)
+            positions = positions[np.argsort(self.starts[positions], kind="stable")]
+            max_length = int((self.ends[positions] - self.starts[positions]).max())
+            self.frames[int(frame)] = (self.starts[positions], self.ends[positions], positions, max_length)
+        self.frame_values = frames
+        self._comparitor_partners = None
+
+    def partners(self, starts, ends, frames):
+        # For each record, the positions of the comparitors it would merge with, in input order
+        # A frame's sign encodes the strand, so partitioning by frame also partitions by direction.
+        pair_records = []
+        pair_positions = []
+        for frame, (frame_starts, frame_ends, positions, max_length) in self.frames.items():
+            records = np.flatnonzero(frames == frame)
+            if not len(records):
+                continue
+            lows = np.searchsorted(frame_starts, starts[records] - NEIGHBOUR_DISTANCE - max_length, side="left")
+            highs = np.searchsorted(frame_starts, ends[records] + NEIGHBOUR_DISTANCE, side="right")
+            counts = highs - lows
+            window_records = np.repeat(records, counts)
+            window_index = np.repeat(lows - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            is_partner = merge_partner_mask(starts[window_records], ends[window_records],
+                                            frame_starts[window_index], frame_ends[window_index])
+            pair_records.append(window_records[is_partner])
+            pair_positions.append(positions[window_index[is_partner]])
+        if not pair_records:
+            return [[] for _ in range(len(starts))]
+        pair_records = np.concatenate(pair_records)
+        pair_positions = np.concatenate(pair_positions)
+        order = np.lexsort((pair_positions, pair_records))
+        flat_positions = pair_positions[order].tolist()
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(pair_records, minlength=len(starts))))).tolist()
+        return [flat_positions[bounds[index]:bounds[index + 1]] for index in range(len(starts))]
+
+    def comparitor_partners(self):
+        if self._comparitor_partners is None:
+            self._comparitor_partners = self.partners(self.starts, self.ends, self.frame_values)
+        return self._comparitor_partners
+
+    def merge_candidates(self, records):
+        # Records that are themselves comparitors, as in a scaffold merged against itself, share their partners
+        comparitor_positions = {id(record): position for position, record in enumerate(self.records)}
+        positions = [comparitor_positions.get(id(record)) for record in records]
+        outside = [index for index, position in enumerate(positions) if position is None]
+        record_partners = {}
+        if outside:
+            record_partners.update(zip(outside, self.partners(*record_arrays([records[index] for index in outside]))))
+        if len(outside) < len(records):
+            comparitor_partners = self.comparitor_partners()
+            for index, position in enumerate(positions):
+                if position is not None:
+                    record_partners[index] = comparitor_partners[position]
+        return [self.fold_partners(record, record_partners[index]) for index, record in enumerate(records)]
+
+    def fold_partners(self, record, partners):
+        # Equivalent to folding the record over every comparitor, visiting only the partners of what it takes on
+        candidate = record
+        pending = list(partners)
+        queued = set(pending)
+        while pending:
+            position = heappop(pending)
+            comparitor = self.records[position]
+            if candidate.is_superset(comparitor):
+                candidate = comparitor
+            elif candidate.is_near_neighbour(comparitor) or candidate.is_range_extension(comparitor):
+                candidate = ProbeData.merge_records(candidate, comparitor)
+            else:
+                continue
+            for partner in self.comparitor_partners()[position]:
+                if partner > position and partner not in queued:
+                    queued.add(partner)
+                    heappush(pending, partner)
+        return candidate
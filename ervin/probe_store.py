@@ -0,0 +1,186 @@
+from .exceptions import InvalidProbeStoreException
+
+from .probe_table import ProbeTable
+
+from array import array
+from pathlib import Path
+
+import json
+import mmap
+import numpy as np
+import struct
+import sys
+
+PROBE_STORE_SUFFIX = ".probes"
+PROBE_STORE_MAGIC = b"ERVNPHS1"
+HEADER_LENGTH = struct.Struct("<I")
+SECTION_ALIGNMENT = 8
+# Numeric columns as (ProbeTable attribute, array typecode, widest stored dtype)
+NUMERIC_COLUMNS = [
+    ("starts", "q", "<i8"),
+    ("ends", "q", "<i8"),
+    ("frames", "b", "<i1"),
+    ("strands", "b", "<i1"),
+    ("alignment_lengths", "q", "<i8"),
+    ("scaffold_lengths", "q", "<i8"),
+]
+# Few distinct values recur across many hits in these, so each is stored once and referred to by code
+TEXT_COLUMNS = ["accession_ids", "scaffolds", "e_values"]
+# Written last, so that readers skipping the sequences never touch these pages
+SEQUENCE_COLUMNS = ["acc_sequences", "scaffold_alignments"]
+
+
+def read_header(store_in):
+    if store_in.read(len(PROBE_STORE_MAGIC)) != PROBE_STORE_MAGIC:
+        raise InvalidProbeStoreException(f"{store_in.name} is not a probe hit store")
+    (header_length,) = HEADER_LENGTH.unpack(store_in.read(HEADER_LENGTH.size))
+    return json.loads(store_in.read(header_length)), len(PROBE_STORE_MAGIC) + HEADER_LENGTH.size + header_length
+
+
+def is_probe_store(filepath):
+    with open(filepath, "rb") as file_in:
+        return file_in.read(len(PROBE_STORE_MAGIC)) == PROBE_STORE_MAGIC
+
+
+def string_sections(name, values):
+    encoded = [value.encode() for value in values]
+    data = b"".join(encoded)
+    offset_dtype = "<u4" if len(data) < 2 ** 32 else "<i8"
+    offsets = np.zeros(len(encoded) + 1, dtype=offset_dtype)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return [(f"{name}.offsets", offset_dtype, offsets.tobytes()), (f"{name}.data", "|u1", data)]
+
+
+def coded_text_sections(name, values):
+    value_codes = {}
+    codes = np.fromiter((value_codes.setdefault(value, len(value_codes)) for value in values), dtype="<u4",
+                        count=len(values))
+    return [(f"{name}.codes", "<u4", codes.tobytes()), *string_sections(f"{name}.values", value_codes)]
+
+
+def write_probe_store_sections(store_out, records):
+    # Magic, a length-prefixed JSON header, then each column on an 8 byte boundary for memory-mapping
+    table = records if isinstance(records, ProbeTable) else ProbeTable(records)
+    sections = []
+    for name, _, dtype in NUMERIC_COLUMNS:
+        values = np.array(getattr(table, name), dtype=dtype)
+        if dtype == "<i8" and (not len(values) or np.abs(values).max() < 2 ** 31):
+            dtype = "<i4"
+        sections.append((name, dtype, values.astype(dtype).tobytes()))
+    for name in TEXT_COLUMNS:
+        sections.extend(coded_text_sections(name, getattr(table, name)))
+    for name in SEQUENCE_COLUMNS:
+        sections.extend(string_sections(name, getattr(table, name)))
+    columns = {}
+    offset = 0
+    for name, dtype, data in sections:
+        columns[name] = {"dtype": dtype, "offset": offset, "length": len(data)}
+        offset += -(-len(data) // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+    header = json.dumps({"count": len(table), "columns": columns}).encode()
+    data_start = len(PROBE_STORE_MAGIC) + HEADER_LENGTH.size + len(header)
+    padding = -data_start % SECTION_ALIGNMENT
+    store_out.write(PROBE_STORE_MAGIC)
+    store_out.write(HEADER_LENGTH.pack(len(header) + padding))
+    store_out.write(header + b" " * padding)
+    for _, _, data in sections:
+        store_out.write(data)
+        store_out.write(b"\0" * (-len(data) % SECTION_ALIGNMENT))
+
+
+def write_probe_store(filepath, records):
+    with open(filepath, "wb") as store_out:
+        write_probe_store_sections(store_out, records)
+    return filepath
+
+
+def append_probe_store(store_out, records):
+    # Appends the records to an open file as a store of their own, returning the offset to read them back from
+    offset = store_out.tell()
+    store_out.write(b"\0" * (-offset % SECTION_ALIGNMENT))
+    offset += -offset % SECTION_ALIGNMENT
+    write_probe_store_sections(store_out, records)
+    return offset
+
+
+class ProbeStore:
+    """Memory-mapped reader for a probe hit store, decoding columns only as they are asked for"""
+
+    def __init__(self, filepath, offset=0):
+        self.filepath = Path(filepath)
+        with open(filepath, "rb") as store_in:
+            store_in.seek(offset)
+            header, data_start = read_header(store_in)
+            self.data_start = offset + data_start
+            self._map = mmap.mmap(store_in.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = header["count"]
+        self.columns = header["columns"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.to_table())
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Arrays viewing the mapping are still alive, and it is released along with them
+            pass
+
+    def section(self, name):
+        column = self.columns[name]
+        dtype = np.dtype(column["dtype"])
+        return np.frombuffer(self._map, dtype=dtype, count=column["length"] // dtype.itemsize,
+                             offset=self.data_start + column["offset"])
+
+    def string_column(self, name):
+        offsets = self.section(f"{name}.offsets").tolist()
+        data = self.section(f"{name}.data").tobytes()
+        return [data[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+
+    def text_column(self, name):
+        values = [sys.intern(value) for value in self.string_column(f"{name}.values")]
+        return [values[code] for code in self.section(f"{name}.codes").tolist()]
+
+    def scaffold_names(self):
+        return self.string_column("scaffolds.values")
+
+    def to_table(self, include_sequences=True):
+        table = ProbeTable()
+        for name, typecode, _ in NUMERIC_COLUMNS:
+            column = array(typecode)
+            column.frombytes(self.section(name).astype(np.dtype(typecode)).tobytes())
+            setattr(table, name, column)
+        for name in TEXT_COLUMNS:
+            setattr(table, name, self.text_column(name))
+        for name in SEQUENCE_COLUMNS:
+            setattr(table, name, self.string_column(name) if include_sequences else [""] * self.count)
+        return table
+
+
+def read_probe_store(filepath, include_sequences=True, offset=0):
+    with ProbeStore(filepath, offset) as store:
+        return store.to_table(include_sequences)
+
+
+def count_probe_records(filepaths):
+    # Read from each store's header, without mapping any of its columns
+    total_records = 0
+    for filepath in filepaths:
+        with open(filepath, "rb") as store_in:
+            total_records += read_header(store_in)[0]["count"]
+    return total_records
+
+
+def export_probe_store_to_tsv(store_path, tsv_path):
+    with open(tsv_path, "w") as tsv_out:
+        for record in read_probe_store(store_path):
+            tsv_out.write(record.to_tsv())
+    return tsv_path
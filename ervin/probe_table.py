@@ -0,0 +1,102 @@
+from .probe_data import ProbeData
+
+from array import array
+from itertools import compress
+
+import numpy as np
+import sys
+
+
+class ProbeTable:
+    """Column-oriented store for large sets of probe hits, holding one array or list per ProbeData field"""
+
+    def __init__(self, records=None):
+        self.accession_ids = []
+        self.scaffolds = []
+        self.scaffold_lengths = array("q")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.e_values = []
+        self.alignment_lengths = array("q")
+        self.acc_sequences = []
+        self.scaffold_alignments = []
+        self.frames = array("b")
+        # 1 for hits on the positive strand ("P"), -1 for the negative strand ("N")
+        self.strands = array("b")
+        if records is not None:
+            self.extend(records)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        record = ProbeData()
+        record.accession_id = self.accession_ids[index]
+        record.scaffold = self.scaffolds[index]
+        record.scaffold_length = self.scaffold_lengths[index]
+        record.start = self.starts[index]
+        record.end = self.ends[index]
+        record.e_value = self.e_values[index]
+        record.alignment_length = self.alignment_lengths[index]
+        record.acc_sequence = self.acc_sequences[index]
+        record.scaffold_alignment = self.scaffold_alignments[index]
+        record.frame = self.frames[index]
+        record.direction = "P" if self.strands[index] > 0 else "N"
+        record.matched = False
+        record.printed = False
+        return record
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def select(self, mask):
+        # Numeric columns are masked as NumPy views over their buffers
+        table = ProbeTable()
+        for name, column in vars(self).items():
+            if isinstance(column, array):
+                selected = array(column.typecode)
+                selected.frombytes(np.frombuffer(column, dtype=column.typecode)[mask].tobytes())
+            else:
+                selected = list(compress(column, mask))
+            setattr(table, name, selected)
+        return table
+
+    def above_alignment_length(self, threshold):
+        if threshold is None:
+            return self
+        return self.select(np.frombuffer(self.alignment_lengths, dtype=np.int64) > threshold)
+
+    def append(self, record):
+        self.accession_ids.append(sys.intern(record.accession_id))
+        self.scaffolds.append(sys.intern(record.scaffold))
+        self.scaffold_lengths.append(record.scaffold_length)
+        self.starts.append(record.start)
+        self.ends.append(record.end)
+        self.e_values.append(record.e_value)
+        self.alignment_lengths.append(record.alignment_length)
+        self.acc_sequences.append(record.acc_sequence)
+        self.scaffold_alignments.append(record.scaffold_alignment)
+        self.frames.append(record.frame)
+        self.strands.append(1 if record.direction == "P" else -1)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def append_tsv_line(self, line):
+        # Parses straight into the columns, without building an intermediate ProbeData
+        line_tokens = line.strip().split("\t")
+        first_position = int(line_tokens[3])
+        second_position = int(line_tokens[4])
+        self.accession_ids.append(sys.intern(line_tokens[0]))
+        self.scaffolds.append(sys.intern(line_tokens[1]))
+        self.scaffold_lengths.append(int(line_tokens[2]))
+        self.starts.append(min(first_position, second_position))
+        self.ends.append(max(first_position, second_position))
+        self.e_values.append(line_tokens[5])
+        self.alignment_lengths.append(int(line_tokens[6]))
+        self.acc_sequences.append(line_tokens[7])
+        self.scaffold_alignments.append(line_tokens[8])
+        self.frames.append(int(line_tokens[9]))
+        self.strands.append(1 if first_position < second_position else -1)
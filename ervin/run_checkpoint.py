@@ -0,0 +1,138 @@
+from .ervin_utils import get_config
+from .ervin_utils import homify_path
+
+from .exceptions import RunNotFoundException
+
+from pathlib import Path
+
+import json
+import logging
+import os
+import shutil
+import time
+
+RUNS_DIR = "runs"
+CHECKPOINT_FILE = "checkpoint.json"
+UNITS_SUFFIX = ".units.jsonl"
+UNIT_DATA_SUFFIX = ".units"
+
+LOGGER = logging.getLogger(Path(__file__).stem)
+
+
+def run_dir_for(run_ts):
+    return Path(homify_path(get_config().operational_data_storage)) / RUNS_DIR / run_ts
+
+
+def repair_unit_log(path):
+    # A run killed mid-write leaves a partial last line, which is dropped so that new units start on a clean line
+    if not path.exists() or path.stat().st_size == 0:
+        return
+    with open(path, "rb+") as unit_file:
+        unit_file.seek(-1, os.SEEK_END)
+        if unit_file.read(1) == b"\n":
+            return
+        unit_file.seek(0)
+        contents = unit_file.read()
+        unit_file.truncate(contents.rfind(b"\n") + 1)
+
+
+class UnitLog:
+    """Append-only record of the units of work that a stage has finished"""
+
+    def __init__(self, path):
+        repair_unit_log(path)
+        self._file = open(path, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def record(self, unit, **payload):
+        self._file.write(json.dumps({"unit": unit, **payload}) + "\n")
+        # Flushed per unit so that a killed run loses at most the unit in flight
+        self._file.flush()
+
+
+class RunCheckpoint:
+    """Progress of an ervin run, kept on disk under the run timestamp so that an interrupted run can resume"""
+
+    def __init__(self, run_dir, state):
+        self.run_dir = run_dir
+        self.state = state
+
+    @classmethod
+    def create(cls, run_ts, run_args):
+        run_dir = run_dir_for(run_ts)
+        # Anything left under the same timestamp belongs to an earlier run and must not be resumed into this one
+        shutil.rmtree(run_dir, ignore_errors=True)
+        run_dir.mkdir(parents=True)
+        checkpoint = cls(run_dir, {"run_ts": run_ts, "args": run_args, "stages": {}})
+        checkpoint.save()
+        return checkpoint
+
+    @classmethod
+    def load(cls, run_ts):
+        run_dir = run_dir_for(run_ts)
+        checkpoint_path = run_dir / CHECKPOINT_FILE
+        if not checkpoint_path.exists():
+            raise RunNotFoundException(f"No checkpoint found for run {run_ts} in {run_dir}")
+        with open(checkpoint_path) as checkpoint_in:
+            return cls(run_dir, json.load(checkpoint_in))
+
+    @property
+    def run_ts(self):
+        return self.state["run_ts"]
+
+    @property
+    def run_args(self):
+        return self.state["args"]
+
+    def save(self):
+        checkpoint_path = self.run_dir / CHECKPOINT_FILE
+        temp_path = checkpoint_path.with_suffix(".tmp")
+        with open(temp_path, "w") as checkpoint_out:
+            json.dump(self.state, checkpoint_out, indent=2)
+            checkpoint_out.flush()
+            os.fsync(checkpoint_out.fileno())
+        os.replace(temp_path, checkpoint_path)
+
+    def is_complete(self, stage):
+        return self.state["stages"].get(stage, {}).get("complete", False)
+
+    def stage_outputs(self, stage):
+        return self.state["stages"][stage]["outputs"]
+
+    def complete_stage(self, stage, **outputs):
+        self.state["stages"][stage] = {"complete": True, "completed_at": time.time(), "outputs": outputs}
+        self.save()
+        LOGGER.info(f"Run {self.run_ts}: {stage} complete")
+
+    def units_path(self, stage):
+        return self.run_dir / f"{stage}{UNITS_SUFFIX}"
+
+    def completed_units(self, stage):
+        units_path = self.units_path(stage)
+        repair_unit_log(units_path)
+        units = {}
+        if units_path.exists():
+            with open(units_path) as units_in:
+                for line in units_in:
+                    unit = json.loads(line)
+                    units[unit.pop("unit")] = unit
+        return units
+
+    def unit_data_path(self, stage, suffix):
+        # For unit results too bulky for the log itself
+        return self.run_dir / f"{stage}{UNIT_DATA_SUFFIX}{suffix}"
+
+    def discard(self):
+        # Once a run has finished there is nothing left to resume
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def unit_log(self, stage):
+        return UnitLog(self.units_path(stage))
@@ -1,18 +1,18 @@
 from .defaults import CONFIG_FILEPATH
 from .defaults import NEWLINE
-from .defaults import TEMP_BLASTN_OUTPUT
 from .defaults import TEMP_FASTA_FILE
 from .defaults import LTR_LOWER
 from .defaults import LTR_UPPER
 from .defaults import LTR_OUTFILE
 from .defaults import ENV_UPPER
 
+from .blast_runner import run_blast_program
+
 from .exceptions import BadConfigFormatException, IncompleteArgsException
 
-from .scaf_file import ScafRecord
+from .fasta_index import open_fasta_index
 
-from Bio import SeqIO
-from Bio.Blast.Applications import NcbiblastnCommandline
+from .scaf_file import ScafRecord
 
 import argparse
 import json
@@ -112,35 +112,30 @@ def compute_ranges(range_start, range_end):
 
 
 def get_from_db(range_start, range_end, accession_id, filepath):
-    # TODO: Find out DB interface
-    for seq_record in SeqIO.parse(filepath, "fasta"):
-        if seq_record.id == accession_id:
-            return seq_record.seq[range_start:range_end]
-    raise Exception("Accession ID not found.")
+    genome_index = open_fasta_index(filepath)
+    if accession_id not in genome_index:
+        raise Exception("Accession ID not found.")
+    return genome_index.fetch(accession_id, range_start, range_end)
 
 
-def run_blast_against_tempfile():
+def run_blast_against_tempfile(record):
+    # The record is its own subject, which blastn needs as a file, while the query goes in on stdin
     # outfmt=15 -> JSON
     # outfmt=5 -> XML
-    blast_command = NcbiblastnCommandline(out=TEMP_BLASTN_OUTPUT,
-                                          query=TEMP_FASTA_FILE,
-                                          subject=TEMP_FASTA_FILE,
-                                          outfmt=15,
-                                          strand="both")
-    blast_command()
+    blast_output = run_blast_program("blastn",
+                                     query=str(record),
+                                     subject=TEMP_FASTA_FILE,
+                                     outfmt=15,
+                                     strand="both")
+    return json.loads(NEWLINE.join(blast_output))
 
 
 def write_result_to_tempfile(record):
     record.print_to_file(TEMP_FASTA_FILE)
 
 
-def read_blast_result_from_file():
-    with open(TEMP_BLASTN_OUTPUT) as blast_file:
-        return json.load(blast_file)
-
-
-def get_blast_results():
-    blast_data = read_blast_result_from_file()["BlastOutput2"][0]["report"]
+def get_blast_results(blast_output):
+    blast_data = blast_output["BlastOutput2"][0]["report"]
     return blast_data["results"]["bl2seq"][0]
 
 
@@ -220,8 +215,7 @@ def run():
                                  segment=get_from_db(new_range_start, new_range_end,
                                                      record["accession_id"], db_filepath))
         write_result_to_tempfile(scaf_record)
-        run_blast_against_tempfile()
-        blast_results = get_blast_results()
+        blast_results = get_blast_results(run_blast_against_tempfile(scaf_record))
         ltr_candidates.extend(determine_ltr_hits(blast_results, db_filepath))
     print_ltr_candidates_to_file(ltr_candidates)
     # TODO: Plug the LTR segments into the VIRUS DB to confirm them further
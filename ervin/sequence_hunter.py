@@ -1,5 +1,3 @@
-from Bio import SeqIO
-
 input_filepath = "scaf.txt"
 output_filepath = "output.txt"
 fasta_filepath = "blah.fasta"
@@ -37,19 +35,41 @@ def construct_file_line(scaf_record, segment):
         f"{scaf_record.direction}\n{segment}\n"
 
 
+def read_scaf_records(filepath):
+    # Several segments can be requested from the same scaffold, so they're grouped per accession
+    scaf_records = {}
+    with open(filepath) as input_file_reader:
+        for line in input_file_reader:
+            scaf_record = ScafRecord(record_line=line)
+            scaf_records.setdefault(scaf_record.accession_id, []).append(scaf_record)
+    return scaf_records
+
+
+def stream_wanted_sequences(fasta_path, wanted_ids):
+    # Single pass over the fasta, only holding on to the sequence lines of the wanted records
+    seq_id = None
+    sequence_lines = None
+    with open(fasta_path) as fasta_in:
+        for line in fasta_in:
+            if line.startswith(">"):
+                if sequence_lines is not None:
+                    yield seq_id, "".join(sequence_lines)
+                title_tokens = line[1:].split(maxsplit=1)
+                seq_id = title_tokens[0] if title_tokens else ""
+                sequence_lines = [] if seq_id in wanted_ids else None
+            elif sequence_lines is not None:
+                sequence_lines.append("".join(line.split()))
+    if sequence_lines is not None:
+        yield seq_id, "".join(sequence_lines)
+
+
 def find_sequence_segments():
-    with open(input_filepath) as input_file_reader:
-        with open(output_filepath, 'w') as output_file_writer:
-            scaf_records = {}
-            for line in input_file_reader:
-                scaf_record = ScafRecord(record_line=line)
-                scaf_records[scaf_record.accession_id] = scaf_record
-            for seq_record in SeqIO.parse(fasta_filepath, "fasta"):
-                if seq_record.id in scaf_records.keys():
-                    scaf_record = scaf_records[seq_record.id]
-                    output_file_writer.write(
-                        construct_file_line(scaf_record,
-                                            str(seq_record.seq[scaf_record.start:scaf_record.end])))
+    scaf_records = read_scaf_records(input_filepath)
+    with open(output_filepath, 'w') as output_file_writer:
+        for seq_id, sequence in stream_wanted_sequences(fasta_filepath, scaf_records.keys()):
+            for scaf_record in scaf_records[seq_id]:
+                output_file_writer.write(construct_file_line(scaf_record,
+                                                             sequence[scaf_record.start:scaf_record.end]))
 
 
 if __name__ == "__main__":
@@ -6,5 +6,11 @@ CONFIG_TEMPLATE = {
   "range_expansion_size": 5000,
   "range_size": 100,
   "probe_blaster_align_len_thresh": 400,
-  "probe_blaster_e_value_thresh": 0.009
+  "probe_blaster_e_value_thresh": 0.009,
+  "virus_db_pipe_to_makeblastdb": False,
+  "virus_db_check_ttl": 86400,
+  "virus_hit_cache_size": 1000000,
+  "probe_hit_cache_size": 100000,
+  "blast_concurrency": None,
+  "blast_timeout": None
 }
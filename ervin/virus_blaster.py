@@ -1,35 +1,66 @@
+from .ervin_utils import DECOMPRESS_CHUNK_SIZE
 from .ervin_utils import DEFAULT_OUTPUT_DIR
 from .ervin_utils import MAKE_BLASTDB_CMD
-from .ervin_utils import TEMP_FASTA_FILE
 from .ervin_utils import VIRUS_DB_SERVER
 from .ervin_utils import VIRUS_DB_SERVER_DIR
-from .ervin_utils import decompress_gz_files
-from .ervin_utils import delete_directory_contents
+from .ervin_utils import VIRUS_DB_SERVER_PORT
+from .ervin_utils import batch_records
+from .ervin_utils import count_fasta_records
+from .ervin_utils import decompress_gz_file
 from .ervin_utils import ensure_output_dir_exists
+from .ervin_utils import format_fasta_records
 from .ervin_utils import format_timestamp_for_filename
 from .ervin_utils import get_config
 from .ervin_utils import homify_path
-from .ervin_utils import print_to_fasta_file
-from .ervin_utils import read_from_fasta_file
+from .ervin_utils import imap_batches
+from .ervin_utils import iter_fasta_file
 from .ervin_utils import sanitise_string
-from .ervin_utils import total_result_records
+from .ervin_utils import stream_gz_files
 
-from .probe_blaster import print_probe_to_temp_fasta_file
+from .blast_cache import TopHitCache
 
-from Bio.Blast.Applications import NcbiblastnCommandline
+from .blast_runner import run_blast_program
+
+from .ftp_utils import RemoteFile
+from .ftp_utils import connect_to_ftp_dir
+from .ftp_utils import download_files
+from .ftp_utils import list_remote_files_mlsd
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
 import argparse
-import ftputil
+import hashlib
 import json
 import logging
+import os
 import progressbar
+import shutil
 import subprocess
+import tempfile
 import time
 
 
 VIRUS_DB_DEFAULT = "Viruses"
 VIRUS_DATABASE_ID = "10239"
+VIRUS_NOT_FOUND = "not_found"
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_JOBS = 1
+VIRUS_DB_DOWNLOAD_CONNECTIONS = 4
+STAGING_SUFFIX = ".staging"
+RETIRED_SUFFIX = ".old"
+BUILD_SUFFIX = ".build-"
+LINK_SUFFIX = ".link"
+VIRUS_DB_MANIFEST = "manifest.json"
+VIRUS_DB_LISTING_CACHE = "virus_db_listing.json"
+DEFAULT_VIRUS_DB_CHECK_TTL = 24 * 60 * 60
+TOP_HIT_CACHE_FILE = "virus_top_hits.sqlite"
+DEFAULT_TOP_HIT_CACHE_SIZE = 1000000
+# Per-virus output files held open at once, the least recently written being closed beyond this
+MAX_OPEN_VIRUS_FILES = 256
 LOGGER = logging.getLogger(Path(__file__).stem)
 
 
@@ -42,77 +73,260 @@ def get_local_virus_db_version(storage_path):
             return int(version.read().strip())
 
 
-def get_newest_ftp_file_timestamp(ftp_handle):
-    file_stats = [ftp_handle.stat(file) for file in ftp_handle.listdir(ftp_handle.curdir)]
-    return int(max([file_stat.st_mtime for file_stat in file_stats]))
+def connect_to_virus_db_server(server=VIRUS_DB_SERVER, port=VIRUS_DB_SERVER_PORT):
+    return connect_to_ftp_dir(server, VIRUS_DB_SERVER_DIR, port)
 
 
-def get_web_virus_db_version():
-    with ftputil.FTPHost(VIRUS_DB_SERVER, "anonymous", "") as virus_serv:
-        virus_serv.chdir(VIRUS_DB_SERVER_DIR)
-        return get_newest_ftp_file_timestamp(virus_serv)
+def virus_db_listing_cache_path():
+    return Path(homify_path(get_config().operational_data_storage)) / VIRUS_DB_LISTING_CACHE
 
 
-def virus_db_update_required():
+def read_cached_remote_listing(cache_path, source, ttl):
+    if not cache_path.exists():
+        return None
+    try:
+        with open(cache_path) as cache_in:
+            cached_listing = json.load(cache_in)
+    except (OSError, ValueError):
+        LOGGER.warning(f"Ignoring unreadable virus DB listing cache {cache_path}")
+        return None
+    if cached_listing["source"] != source or time.time() - cached_listing["checked"] >= ttl:
+        return None
+    return [RemoteFile(*entry) for entry in cached_listing["files"]]
+
+
+def write_cached_remote_listing(cache_path, source, remote_files):
+    # Written under a per-process name and renamed, as concurrent runs may refresh the cache together
+    temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(temp_path, "w") as cache_out:
+        json.dump({"source": source, "checked": time.time(), "files": [list(entry) for entry in remote_files]},
+                  cache_out)
+    os.replace(temp_path, cache_path)
+
+
+def get_remote_virus_db_files(server=VIRUS_DB_SERVER, port=VIRUS_DB_SERVER_PORT):
     config = get_config()
-    virus_db_store = Path(homify_path(config.virus_db_storage))
+    ttl = config.virus_db_check_ttl if config.virus_db_check_ttl is not None else DEFAULT_VIRUS_DB_CHECK_TTL
+    source = f"{server}:{port}/{VIRUS_DB_SERVER_DIR}"
+    cache_path = virus_db_listing_cache_path()
+    remote_files = read_cached_remote_listing(cache_path, source, ttl)
+    if remote_files is None:
+        LOGGER.info(f"Listing virus DB source files on {server}")
+        remote_files = list_remote_files_mlsd(server, VIRUS_DB_SERVER_DIR, port)
+        write_cached_remote_listing(cache_path, source, remote_files)
+    return remote_files
+
+
+def read_virus_db_manifest(virus_db_store):
+    manifest_path = virus_db_store / VIRUS_DB_MANIFEST
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as manifest_in:
+        return json.load(manifest_in)
+
+
+def write_virus_db_manifest(manifest, virus_db_store):
+    manifest_path = virus_db_store / VIRUS_DB_MANIFEST
+    temp_path = manifest_path.with_suffix(".tmp")
+    with open(temp_path, "w") as manifest_out:
+        json.dump(manifest, manifest_out, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def file_sha256(filepath):
+    checksum = hashlib.sha256()
+    with open(filepath, "rb") as file_in:
+        for chunk in iter(partial(file_in.read, DECOMPRESS_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def is_source_file(remote_file):
+    return ".fna" in remote_file.name
+
+
+def manifest_entry_matches(entry, remote_file):
+    return entry is not None and entry["size"] == remote_file.size and entry["mtime"] == remote_file.mtime
+
+
+def changed_source_files(manifest, remote_files):
+    return [remote_file for remote_file in remote_files
+            if is_source_file(remote_file) and not manifest_entry_matches(manifest.get(remote_file.name), remote_file)]
+
+
+def virus_db_update_required(virus_db_store, remote_files):
     if not virus_db_store.exists():
+        if virus_db_store.is_symlink():
+            # Left pointing at a build that has since been removed
+            virus_db_store.unlink()
         virus_db_store.mkdir(parents=True)
         LOGGER.info(f"Created virus db directory: {virus_db_store}")
         return True
-    else:
-        current_version = get_local_virus_db_version(virus_db_store)
-        web_version = get_web_virus_db_version()
-        return current_version < web_version
+    manifest = read_virus_db_manifest(virus_db_store)
+    remote_names = {remote_file.name for remote_file in remote_files if is_source_file(remote_file)}
+    # Stores without a manifest predate the per-file volumes
+    return (not manifest or set(manifest) != remote_names
+            or len(changed_source_files(manifest, remote_files)) > 0)
 
 
-def convert_files_to_db(db_name, source_files):
-    config = get_config()
+def convert_files_to_db(db_name, source_files, db_dir):
     result = subprocess.run(
         MAKE_BLASTDB_CMD.format(
             db_files=" ".join([str(filepath) for filepath in source_files]),
             db_name=db_name,
-            out_path=f"{config.virus_db_storage}{db_name}"),
+            out_path=Path(db_dir) / db_name),
         capture_output=True, shell=True, check=True)
     LOGGER.debug(result)
 
 
-def update_virus_db():
-    if virus_db_update_required():
-        LOGGER.info("Newer virus database version found. Updating...")
-        virus_db_files = get_virus_db_files()
-        decompressed_virus_files = decompress_gz_files(virus_db_files)
-        time.sleep(1)
-        convert_files_to_db(VIRUS_DB_DEFAULT, decompressed_virus_files)
+def convert_gz_files_to_db(db_name, source_files, db_dir):
+    # Feeds the archives through makeblastdb's stdin, so no decompressed copy is ever written to disk
+    command = ["makeblastdb", "-in", "-", "-title", db_name,
+               "-out", str(Path(db_dir) / db_name), "-dbtype", "nucl"]
+    with tempfile.TemporaryFile() as makeblastdb_output:
+        with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=makeblastdb_output,
+                              stderr=subprocess.STDOUT) as makeblastdb:
+            try:
+                stream_gz_files(source_files, makeblastdb.stdin)
+            finally:
+                makeblastdb.stdin.close()
+        makeblastdb_output.seek(0)
+        output = makeblastdb_output.read()
+    LOGGER.debug(output)
+    if makeblastdb.returncode != 0:
+        raise subprocess.CalledProcessError(makeblastdb.returncode, command, output)
+
+
+def volume_name_for(db_name, source_file_name):
+    return f"{db_name}.{source_file_name.split('.fna')[0]}"
+
+
+def volume_files(db_dir, volume_name):
+    return sorted(filepath.name for filepath in Path(db_dir).glob(f"{volume_name}.*"))
+
+
+def build_virus_db_volume(source_file, volume_name, db_dir):
+    if get_config().virus_db_pipe_to_makeblastdb:
+        convert_gz_files_to_db(volume_name, [source_file], db_dir)
+    else:
+        decompressed_file = decompress_gz_file(source_file)
+        convert_files_to_db(volume_name, [decompressed_file], db_dir)
+        os.remove(decompressed_file)
+    return volume_files(db_dir, volume_name)
+
+
+def build_virus_db_alias(db_name, volume_names, db_dir):
+    # Names only, so the alias survives the swap into place
+    command = ["blastdb_aliastool", "-dblist", " ".join(volume_names), "-dbtype", "nucl",
+               "-out", db_name, "-title", db_name]
+    result = subprocess.run(command, capture_output=True, check=True, cwd=db_dir)
+    LOGGER.debug(result)
+
+
+def link_into_dir(source_dir, destination_dir, filenames):
+    for filename in filenames:
+        destination = destination_dir / filename
+        if destination.exists():
+            destination.unlink()
+        try:
+            os.link(source_dir / filename, destination)
+        except OSError:
+            shutil.copy2(source_dir / filename, destination)
+
+
+def virus_db_staging_dir(virus_db_store):
+    return virus_db_store.with_name(virus_db_store.name + STAGING_SUFFIX)
+
+
+def swap_in_virus_db(staging_dir, virus_db_store):
+    # The store path is a symlink to the current build, swapped with a single os.replace
+    build_dir = virus_db_store.with_name(f"{virus_db_store.name}{BUILD_SUFFIX}{time.time_ns()}")
+    os.rename(staging_dir, build_dir)
+    previous_build = Path(os.path.realpath(virus_db_store)) if virus_db_store.is_symlink() else None
+    if virus_db_store.exists() and previous_build is None:
+        # A store from before builds were linked is moved aside
+        retired_store = virus_db_store.with_name(virus_db_store.name + RETIRED_SUFFIX)
+        shutil.rmtree(retired_store, ignore_errors=True)
+        os.rename(virus_db_store, retired_store)
+        previous_build = retired_store
+    link_path = virus_db_store.with_name(virus_db_store.name + LINK_SUFFIX)
+    if link_path.is_symlink():
+        link_path.unlink()
+    os.symlink(build_dir.name, link_path)
+    os.replace(link_path, virus_db_store)
+    if previous_build is not None:
+        shutil.rmtree(previous_build, ignore_errors=True)
+    LOGGER.info(f"Virus db updated in {virus_db_store}")
+
+
+def update_virus_db_volume(source_file, remote_file, previous_entry, virus_db_store, staging_dir):
+    checksum = file_sha256(source_file)
+    volume_name = volume_name_for(VIRUS_DB_DEFAULT, remote_file.name)
+    if previous_entry is not None and previous_entry["sha256"] == checksum:
+        # Only the timestamp changed
+        LOGGER.info(f"{remote_file.name} is unchanged, reusing volume {volume_name}")
+        link_into_dir(virus_db_store, staging_dir, previous_entry["volume_files"])
+        built_files = previous_entry["volume_files"]
     else:
+        LOGGER.info(f"Building volume {volume_name} from {source_file}")
+        built_files = build_virus_db_volume(source_file, volume_name, staging_dir)
+    os.remove(source_file)
+    return {"size": remote_file.size, "mtime": remote_file.mtime, "sha256": checksum,
+            "volume": volume_name, "volume_files": built_files}
+
+
+def update_virus_db(server=VIRUS_DB_SERVER, port=VIRUS_DB_SERVER_PORT, connections=VIRUS_DB_DOWNLOAD_CONNECTIONS):
+    virus_db_store = Path(homify_path(get_config().virus_db_storage))
+    remote_files = get_remote_virus_db_files(server, port)
+    if not virus_db_update_required(virus_db_store, remote_files):
         LOGGER.info("Update not required")
         return
+    LOGGER.info("Newer virus database version found. Updating...")
+    manifest = read_virus_db_manifest(virus_db_store)
+    staging_dir = virus_db_staging_dir(virus_db_store)
+    # Kept after a failed update, to resume its downloads
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    source_files = [remote_file for remote_file in remote_files if is_source_file(remote_file)]
+    files_to_fetch = changed_source_files(manifest, source_files)
+    names_to_fetch = {remote_file.name for remote_file in files_to_fetch}
+    updated_manifest = {}
+    for remote_file in source_files:
+        if remote_file.name not in names_to_fetch:
+            updated_manifest[remote_file.name] = manifest[remote_file.name]
+            link_into_dir(virus_db_store, staging_dir, manifest[remote_file.name]["volume_files"])
+    LOGGER.info(f"{len(files_to_fetch)} of {len(source_files)} virus DB source files have changed")
+    downloaded_files = get_virus_db_files(staging_dir, files_to_fetch, server, port, connections)
+    # makeblastdb is single threaded
+    with ThreadPoolExecutor() as executor:
+        new_entries = executor.map(partial(update_virus_db_volume, virus_db_store=virus_db_store,
+                                           staging_dir=staging_dir),
+                                   downloaded_files, files_to_fetch,
+                                   [manifest.get(remote_file.name) for remote_file in files_to_fetch])
+        for remote_file, entry in zip(files_to_fetch, new_entries):
+            updated_manifest[remote_file.name] = entry
+    build_virus_db_alias(VIRUS_DB_DEFAULT, [updated_manifest[remote_file.name]["volume"]
+                                            for remote_file in source_files], staging_dir)
+    write_virus_db_manifest(updated_manifest, staging_dir)
+    with open(staging_dir / "last_updated", 'w') as version_file:
+        version_file.write(str(max(remote_file.mtime for remote_file in remote_files)))
+    swap_in_virus_db(staging_dir, virus_db_store)
+
+
+def get_virus_db_files(staging_dir, remote_files, server=VIRUS_DB_SERVER, port=VIRUS_DB_SERVER_PORT,
+                       connections=VIRUS_DB_DOWNLOAD_CONNECTIONS):
+    connect = partial(connect_to_virus_db_server, server, port)
+    downloaded_count = 0
+    with progressbar.ProgressBar(max_value=len(remote_files),
+                                 type="percentage",
+                                 prefix="Downloading virus DB source files: ") as bar:
 
+        def update_progress(_):
+            nonlocal downloaded_count
+            downloaded_count += 1
+            bar.update(downloaded_count)
 
-def get_virus_db_files():
-    config = get_config()
-    local_virus_db_path = Path(homify_path(config.virus_db_storage))
-    delete_directory_contents(local_virus_db_path)
-    files_to_download = []
-    downloaded_files = []
-    with ftputil.FTPHost(VIRUS_DB_SERVER, "anonymous", "") as virus_serv:
-        virus_serv.chdir(VIRUS_DB_SERVER_DIR)
-        for file in virus_serv.listdir(virus_serv.curdir):
-            if ".fna" in file:
-                files_to_download.append(file)
-        with progressbar.ProgressBar(max_value=len(files_to_download),
-                                     type="percentage",
-                                     prefix="Downloading virus DB source files: ") as bar:
-            for count, file in enumerate(files_to_download):
-                bar.update(count)
-                dest = f"{str(local_virus_db_path)}/{file}"
-                LOGGER.info(f"Downloading {file} to {dest}")
-                virus_serv.download(file, dest)
-                downloaded_files.append(dest)
-        file_version = get_newest_ftp_file_timestamp(virus_serv)
-    with open(local_virus_db_path / "last_updated", 'w') as version_file:
-        version_file.write(str(file_version))
-    return downloaded_files
+        downloaded_files = download_files(connect, remote_files, staging_dir, connections, update_progress)
+    return [str(filepath) for filepath in downloaded_files]
 
 
 def parse_args():
@@ -131,66 +345,182 @@ def parse_args():
                         type=str,
                         required=False,
                         default=VIRUS_DB_DEFAULT)
+    parser.add_argument("-b", "--batch_size",
+                        help="Number of records to submit to each tblastn invocation",
+                        type=int,
+                        required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("-j", "--jobs",
+                        help="Number of tblastn processes to run concurrently",
+                        type=int,
+                        required=False,
+                        default=DEFAULT_JOBS)
+    parser.add_argument("-nu", "--no_update",
+                        help="Use the local virus database as it is, without checking the server for updates",
+                        action="store_true")
     return parser.parse_args()
 
 
-def get_data_from_file(filepath):
+def get_input_filename(filepath):
     try:
-        return read_from_fasta_file(filepath.name)
+        return filepath.name
     except AttributeError:
-        return read_from_fasta_file(filepath)
+        return filepath
 
 
-def get_top_virus_hit(record, db="Viruses"):
-    config = get_config()
-    print_probe_to_temp_fasta_file(record)
-    command = NcbiblastnCommandline(cmd="tblastn",
-                                    outfmt=15,
-                                    query=TEMP_FASTA_FILE,
-                                    db=f"{config.virus_db_storage}{db}")
-    LOGGER.debug(command)
-    query_result = command()
-    parsed_result = json.loads(query_result[0])["BlastOutput2"][0]
-
-    try:
-        return parsed_result["report"]["results"]["search"]["hits"][0]["description"][0]["title"]
-    except IndexError:
-        return "not_found"
-
-
-def print_virus_results_to_file(virus_name, result_list, run_ts, output_dir):
-    destination_dir = ensure_output_dir_exists(output_dir)
-    sanitised_virus_name = sanitise_string(virus_name)
-    filename = destination_dir / f"{sanitised_virus_name}_{run_ts}.fasta"
-    print_to_fasta_file(filename, result_list, mode='a')
-    return filename
+def get_data_from_file(filepath):
+    return iter_fasta_file(get_input_filename(filepath))
 
 
-def viruses_to_total_found(file_list):
-    virus_to_count = {}
-    for filepath in file_list:
-        row_count = total_result_records([filepath])
-        virus_name = filepath.stem[:-20]  # Trim the timestamp from the filename
-        virus_to_count[virus_name] = row_count // 2
-    return virus_to_count
+def get_top_virus_hits(records, db="Viruses"):
+    config = get_config()
+    # Records are renamed by position as probe_finder titles are not unique per query
+    queries = [{"title": f">q{index}", "seq": record["seq"]} for index, record in enumerate(records)]
+    # max_target_seqs=1 alters the search itself, so the first row for each query is taken instead
+    top_hits = {}
+    for query_id, title in run_blast_program("tblastn",
+                                             query=format_fasta_records(queries),
+                                             parse_line=lambda line: line.split("\t", 1),
+                                             outfmt="6 qseqid stitle",
+                                             max_hsps=1,
+                                             db=homify_path(f"{config.virus_db_storage}{db}")):
+        if query_id not in top_hits:
+            top_hits[query_id] = title
+    return [top_hits.get(f"q{index}", VIRUS_NOT_FOUND) for index in range(len(records))]
+
+
+def open_top_hit_cache(db):
+    config = get_config()
+    max_entries = config.virus_hit_cache_size
+    if max_entries is None:
+        max_entries = DEFAULT_TOP_HIT_CACHE_SIZE
+    if max_entries <= 0:
+        return nullcontext()
+    db_version = get_local_virus_db_version(Path(homify_path(config.virus_db_storage)))
+    cache_path = Path(homify_path(config.operational_data_storage)) / TOP_HIT_CACHE_FILE
+    return TopHitCache(cache_path, db, db_version, max_entries)
+
+
+def get_cached_top_virus_hits(records, db="Viruses", cache=None):
+    if cache is None:
+        return get_top_virus_hits(records, db)
+    top_hits = cache.get_many([record["seq"] for record in records])
+    uncached = [index for index, top_hit in enumerate(top_hits) if top_hit is None]
+    if uncached:
+        blasted_hits = get_top_virus_hits([records[index] for index in uncached], db)
+        for index, top_hit in zip(uncached, blasted_hits):
+            top_hits[index] = top_hit
+        cache.put_many([records[index]["seq"] for index in uncached], blasted_hits)
+    return top_hits
+
+
+def classify_records(indexed_records, db="Viruses", cache=None, completed_hits=None):
+    # Records classified before an interrupted run stopped keep the hit recorded for them
+    completed_hits = completed_hits or {}
+    top_hits = [completed_hits.get(index) for index, _ in indexed_records]
+    pending = [position for position, top_hit in enumerate(top_hits) if top_hit is None]
+    if pending:
+        blasted_hits = get_cached_top_virus_hits([indexed_records[position][1] for position in pending], db, cache)
+        for position, top_hit in zip(pending, blasted_hits):
+            top_hits[position] = top_hit
+    return top_hits
+
+
+class VirusFileWriter:
+    """Appends classified records to their per-virus fasta files, counting each virus's records as it goes"""
+
+    def __init__(self, output_dir, run_ts, max_open_files=MAX_OPEN_VIRUS_FILES):
+        self.destination_dir = ensure_output_dir_exists(output_dir)
+        self.run_ts = run_ts
+        self.max_open_files = max_open_files
+        # Counts are keyed by the sanitised name, as that is all that tells viruses apart in the output
+        self.virus_to_count = {}
+        self.filenames = {}
+        self._sanitised_names = {}
+        self._handles = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _handle(self, sanitised_virus_name):
+        handle = self._handles.get(sanitised_virus_name)
+        if handle is not None:
+            self._handles.move_to_end(sanitised_virus_name)
+            return handle
+        if len(self._handles) >= self.max_open_files:
+            _, evicted = self._handles.popitem(last=False)
+            evicted.close()
+        filename = self.filenames.get(sanitised_virus_name)
+        if filename is None:
+            filename = self.destination_dir / f"{sanitised_virus_name}_{self.run_ts}.fasta"
+            self.filenames[sanitised_virus_name] = filename
+            LOGGER.debug(f"Created output .fasta file: {filename}")
+        handle = self._handles[sanitised_virus_name] = open(filename, "a")
+        return handle
+
+    def write(self, virus_name, fasta_record):
+        sanitised_virus_name = self._sanitised_names.get(virus_name)
+        if sanitised_virus_name is None:
+            sanitised_virus_name = self._sanitised_names[virus_name] = sanitise_string(virus_name)
+        self._handle(sanitised_virus_name).write(format_fasta_records([fasta_record]))
+        self.virus_to_count[sanitised_virus_name] = self.virus_to_count.get(sanitised_virus_name, 0) + 1
+        return self.filenames[sanitised_virus_name]
+
+    def close(self):
+        while self._handles:
+            self._handles.popitem()[1].close()
+
+
+def run_virus_blaster_on_records(records, db=None, output_dir=None, run_ts=None, batch_size=None, jobs=None,
+                                 completed_hits=None, unit_log=None, record_count=None):
+    # records may be produced while this runs, in which case record_count is unknown and progress is open ended
+    run_stamp = run_ts if run_ts else format_timestamp_for_filename()
+    records_per_batch = batch_size if batch_size else DEFAULT_BATCH_SIZE
+    worker_count = jobs if jobs else DEFAULT_JOBS
+    classified_records = 0
+    with open_top_hit_cache(db) as top_hit_cache, VirusFileWriter(output_dir, run_stamp) as virus_files, \
+            progressbar.ProgressBar(max_value=record_count if record_count is not None else progressbar.UnknownLength,
+                                    type="percentage",
+                                    prefix="Blasting against Viruses: ") as bar:
+
+        def update_progress(batch):
+            nonlocal classified_records
+            classified_records += len(batch)
+            bar.update(classified_records)
+
+        batches = batch_records(enumerate(records), records_per_batch)
+        # In input order, so the per-virus files match a sequential run
+        classify_batch = partial(classify_records, db=db, cache=top_hit_cache, completed_hits=completed_hits)
+        for batch, top_hits in imap_batches(classify_batch, batches, worker_count, update_progress):
+            for (index, file_record), top_hit in zip(batch, top_hits):
+                virus_files.write(top_hit, file_record)
+                if unit_log is not None:
+                    unit_log.record(index, top_hit=top_hit)
+    return set(virus_files.filenames.values()), virus_files.virus_to_count
+
+
+def ensure_virus_db_current(no_update=False):
+    if no_update:
+        LOGGER.info("Skipping the virus database update check")
+    else:
+        update_virus_db()
 
 
-def run_virus_blaster(filename=None, db=None, output_dir=None, run_ts=None):
-    run_stamp = run_ts if run_ts else format_timestamp_for_filename()
-    update_virus_db()
-    input_data = get_data_from_file(filename)
-    matched_virus_files = set()
-    with progressbar.ProgressBar(max_value=len(input_data),
-                                 type="percentage",
-                                 prefix="Blasting against Viruses: ") as bar:
-        for count, file_record in enumerate(input_data):
-            bar.update(count)
-            top_hit = get_top_virus_hit(file_record, db)
-            matched_virus_files.add(print_virus_results_to_file(top_hit, [file_record],
-                                                                run_stamp, output_dir))
-    return matched_virus_files, viruses_to_total_found(matched_virus_files)
+def run_virus_blaster(filename=None, db=None, output_dir=None, run_ts=None, batch_size=None, jobs=None,
+                      no_update=False, completed_hits=None, unit_log=None):
+    ensure_virus_db_current(no_update)
+    return run_virus_blaster_on_records(get_data_from_file(filename), db, output_dir, run_ts,
+                                        batch_size=batch_size,
+                                        jobs=jobs,
+                                        completed_hits=completed_hits,
+                                        unit_log=unit_log,
+                                        record_count=count_fasta_records(get_input_filename(filename)))
 
 
 if __name__ == "__main__":
     args = parse_args()
-    run_virus_blaster(args.file.name, args.virus_database, args.output_dir)
+    run_virus_blaster(args.file.name, args.virus_database, args.output_dir,
+                      batch_size=args.batch_size, jobs=args.jobs, no_update=args.no_update)
@@ -21,6 +21,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=[
             "biopython==1.73",
+            "numpy==1.16.4",
             "progressbar2==3.39.3",
             "ftputil==3.4"
     ],
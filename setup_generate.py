@@ -11,7 +11,8 @@ SEPARATOR = f",{NEWLINE}{BIG_INDENT}"
 TEST_LIBS = [
     "mock",
     "nose",
-    "flake8"
+    "flake8",
+    "pyftpdlib"
 ]
 SETUP_CONTENT = """import setuptools
 
@@ -0,0 +1,101 @@
+from unittest import TestCase
+from ervin.blast_cache import ProbeHitCache, TopHitCache, genome_db_identity
+from ervin.probe_blaster import run_blast_batch
+from ervin.virus_blaster import get_cached_top_virus_hits
+from mock import patch
+from pathlib import Path
+import os
+import tempfile
+
+
+class TestTopHitCache(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.work_dir.name) / "cache.sqlite"
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_round_trip(self):
+        with TopHitCache(self.cache_path, "Viruses", 100, 10) as cache:
+            cache.put_many(["MKV", "MRL"], ["virus one", "not_found"])
+            self.assertEqual(cache.get_many(["MRL", "AAA", "MKV", "MKV"]),
+                             ["not_found", None, "virus one", "virus one"])
+        with TopHitCache(self.cache_path, "Viruses", 100, 10) as cache:
+            self.assertEqual(cache.get_many(["MKV"]), ["virus one"])
+
+    def test_new_db_version_invalidates_entries(self):
+        with TopHitCache(self.cache_path, "Viruses", 100, 10) as cache:
+            cache.put_many(["MKV"], ["virus one"])
+        with TopHitCache(self.cache_path, "Other", 5, 10) as cache:
+            cache.put_many(["MKV"], ["virus two"])
+        with TopHitCache(self.cache_path, "Viruses", 200, 10) as cache:
+            self.assertEqual(cache.get_many(["MKV"]), [None])
+            self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with TopHitCache(self.cache_path, "Viruses", 100, 3) as cache:
+            for sequence in ["A", "B", "C"]:
+                cache.put_many([sequence], [f"virus {sequence}"])
+            cache.get_many(["A"])
+            cache.put_many(["D"], ["virus D"])
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(cache.get_many(["A", "B", "C", "D"]), ["virus A", None, "virus C", "virus D"])
+
+    @patch("ervin.virus_blaster.get_top_virus_hits", side_effect=lambda records, db: [
+        f"hit for {record['seq']}" for record in records])
+    def test_only_uncached_records_are_blasted(self, mock_blast):
+        records = [{"title": f">scaf {index}", "seq": sequence} for index, sequence in enumerate(["AA", "CC", "GG"])]
+        with TopHitCache(self.cache_path, "Viruses", 100, 10) as cache:
+            cache.put_many(["CC"], ["cached hit"])
+            top_hits = get_cached_top_virus_hits(records, "Viruses", cache)
+            self.assertEqual(top_hits, ["hit for AA", "cached hit", "hit for GG"])
+            mock_blast.assert_called_once_with([records[0], records[2]], "Viruses")
+            self.assertEqual(get_cached_top_virus_hits(records, "Viruses", cache), top_hits)
+            self.assertEqual(mock_blast.call_count, 1)
+
+
+class TestProbeHitCache(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.work_dir.name) / "cache.sqlite"
+        self.probes = [{"title": ">probe1 desc", "seq": "MKV"}, {"title": ">probe2", "seq": "MRL"}]
+        self.hit_lines = [["probe1\tscaf1\t5000\t100\t700\t1e-20\t200\tMKV\tMKV\t1"], []]
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_keyed_by_db_identity_and_e_value(self):
+        with ProbeHitCache(self.cache_path, "genome|a:1:1", 0.009, 10) as cache:
+            cache.put_many(self.probes, self.hit_lines)
+            self.assertEqual(cache.get_many(self.probes[::-1]), self.hit_lines[::-1])
+        with ProbeHitCache(self.cache_path, "genome|a:1:1", 0.01, 10) as cache:
+            self.assertEqual(cache.get_many(self.probes), [None, None])
+        with ProbeHitCache(self.cache_path, "genome|a:2:1", 0.009, 10) as cache:
+            self.assertEqual(cache.get_many(self.probes), [None, None])
+
+    def test_genome_db_identity_follows_db_files(self):
+        db_path = Path(self.work_dir.name) / "genome"
+        (db_path.parent / "genome.nsq").write_bytes(b"sequences")
+        (db_path.parent / "genome2.nsq").write_bytes(b"another database")
+        identity = genome_db_identity(db_path)
+        self.assertEqual(genome_db_identity(db_path), identity)
+        (db_path.parent / "genome2.nsq").write_bytes(b"another database, rebuilt")
+        self.assertEqual(genome_db_identity(db_path), identity)
+        (db_path.parent / "genome.nsq").write_bytes(b"rebuilt sequences")
+        os.utime(db_path.parent / "genome.nsq", (0, 0))
+        self.assertNotEqual(genome_db_identity(db_path), identity)
+
+    @patch("ervin.probe_blaster.run_blast_batch_lines")
+    def test_cached_probes_skip_tblastn(self, mock_blast):
+        mock_blast.return_value = self.hit_lines[:1]
+        with ProbeHitCache(self.cache_path, "genome", 0.009, 10) as cache:
+            cache.put_many(self.probes[1:], self.hit_lines[1:])
+            results = run_blast_batch(self.probes, "genome", 0.009, cache)
+            mock_blast.assert_called_once_with(self.probes[:1], "genome", 0.009)
+            self.assertEqual([[record.to_tsv() for record in result] for result in results],
+                             [[f"{self.hit_lines[0][0]}\n"], []])
+            run_blast_batch(self.probes, "genome", 0.009, cache)
+            self.assertEqual(mock_blast.call_count, 1)
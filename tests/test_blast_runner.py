@@ -0,0 +1,60 @@
+from unittest import TestCase
+from ervin.blast_runner import BlastRunner, build_blast_command
+from ervin.exceptions import BlastTimeoutException
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class TestBlastRunner(TestCase):
+
+    def setUp(self):
+        self.runner = BlastRunner(max_concurrent=2, timeout=5)
+
+    def test_build_blast_command(self):
+        self.assertEqual(build_blast_command("tblastn", query="", outfmt="6 qseqid stitle", max_hsps=1,
+                                             evalue=None, ungapped=True),
+                         ["tblastn", "-query", "-", "-outfmt", "6 qseqid stitle", "-max_hsps", "1", "-ungapped"])
+
+    def test_query_is_streamed_through_stdin(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Stands in for a BLAST program, echoing its arguments and then the query it reads from stdin
+            fake_blast = Path(work_dir) / "fake_blast"
+            fake_blast.write_text(f"#!{sys.executable}\nimport sys\nprint(' '.join(sys.argv[1:]))\n"
+                                  f"for line in sys.stdin: print(line.strip().upper())\n")
+            fake_blast.chmod(0o755)
+            self.assertEqual(list(self.runner.run(str(fake_blast), query=">q0\nmkv\n", outfmt=6)),
+                             ["-query - -outfmt 6", ">Q0", "MKV"])
+            self.assertEqual(list(self.runner.run(str(fake_blast), query="a\tb\n",
+                                                  parse_line=lambda line: line.split("\t"))),
+                             [["-query -"], ["A", "B"]])
+
+    def test_lines_are_yielded_while_the_program_runs(self):
+        output = self.runner.run(sys.executable, c="import time; print('first', flush=True); time.sleep(30)")
+        started = time.perf_counter()
+        self.assertEqual(next(output), "first")
+        self.assertLess(time.perf_counter() - started, 5)
+        output.close()
+
+    def test_failure_raises_called_process_error(self):
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            list(self.runner.run(sys.executable, c="import sys; sys.stderr.write('bad db'); sys.exit(2)"))
+        self.assertEqual(raised.exception.returncode, 2)
+        self.assertEqual(raised.exception.stderr, b"bad db")
+
+    def test_timeout_kills_the_program(self):
+        self.runner.timeout = 0.2
+        with self.assertRaises(BlastTimeoutException):
+            list(self.runner.run(sys.executable, c="import time; time.sleep(30)"))
+
+    def test_concurrency_is_limited(self):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: list(self.runner.run(sys.executable, c="import time; time.sleep(0.3)")),
+                              range(4)))
+        elapsed = time.perf_counter() - started
+        self.assertGreaterEqual(elapsed, 0.6)
+        self.assertLess(elapsed, 1.2)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from ervin.ervin import PIPELINE_QUEUE_SIZE, run_pipelined_stages
+from ervin.probe_data import ProbeData
+from mock import MagicMock, patch
+import argparse
+import threading
+
+
+def merged_scaffolds(yielded):
+    for count in range(PIPELINE_QUEUE_SIZE * 10):
+        yielded.append(count)
+        yield f"scaf{count}", [ProbeData(f"acc{count}\tscaf{count}\t100000\t100\t400\t1e-50\t300\tMKLV\tACGT\t1")]
+
+
+def failing_virus_blaster(records, *_, **__):
+    for count, _ in enumerate(records):
+        if count == 3:
+            raise RuntimeError("virus BLAST failed")
+
+
+class TestPipelinedStages(TestCase):
+
+    @patch("ervin.ervin.run_virus_blaster_on_records", side_effect=failing_virus_blaster)
+    @patch("ervin.ervin.checkpointed_probe_results", return_value=iter([]))
+    @patch("ervin.ervin.remove_virus_blaster_outputs")
+    @patch("ervin.ervin.ensure_virus_db_current")
+    def test_merger_stops_when_virus_blasting_fails(self, *_):
+        yielded = []
+        checkpoint = MagicMock()
+        checkpoint.completed_units.return_value = {}
+        run_args = argparse.Namespace(no_update=True, output_dir="out", alignment_len_threshold=None,
+                                      single_pass=False, jobs=None, virus_database="Viruses", batch_size=None,
+                                      compression=None)
+        with patch("ervin.ervin.iter_merged_scaffolds", side_effect=lambda *_, **__: merged_scaffolds(yielded)), \
+                patch("ervin.ervin.write_probe_finder_results") as write_results:
+            with self.assertRaises(RuntimeError):
+                run_pipelined_stages(checkpoint, run_args, "ts")
+        self.assertNotIn("probe-finder", [thread.name for thread in threading.enumerate()])
+        self.assertLess(len(yielded), PIPELINE_QUEUE_SIZE * 10)
+        write_results.assert_not_called()
+        checkpoint.complete_stage.assert_not_called()
@@ -0,0 +1,92 @@
+from unittest import TestCase
+from mock import patch
+from ervin.ervin_utils import get_config
+from ervin.ervin_utils import imap_batches
+from ervin.ervin_utils import stream_gz_files
+from pathlib import Path
+from ervin.templates.config_template import CONFIG_TEMPLATE
+import gzip
+import io
+import json
+import tempfile
+import threading
+import time
+
+FIXTURE_CONTENTS = [b">virus1\nACGTACGT\n", b">virus2\nTTGGCCAA\nGGCC\n", b">virus3\nA\n"]
+
+
+def write_gz_fixtures(fixture_dir):
+    fixture_files = []
+    for index, contents in enumerate(FIXTURE_CONTENTS):
+        fixture_file = Path(fixture_dir) / f"viral.{index}.fna.gz"
+        with gzip.open(fixture_file, "wb") as archive:
+            archive.write(contents)
+        fixture_files.append(str(fixture_file))
+    return fixture_files
+
+
+class TestStreamGzFiles(TestCase):
+
+    def test_files_are_concatenated_in_list_order(self):
+        with tempfile.TemporaryDirectory() as fixture_dir:
+            fixture_files = write_gz_fixtures(fixture_dir)
+            for order in [fixture_files, fixture_files[::-1]]:
+                destination = io.BytesIO()
+                stream_gz_files(order, destination)
+                expected = b"".join(FIXTURE_CONTENTS[fixture_files.index(filepath)] for filepath in order)
+                self.assertEqual(destination.getvalue(), expected)
+
+    @patch("ervin.ervin_utils.DECOMPRESS_CHUNK_SIZE", 3)
+    def test_chunks_smaller_than_a_file_are_joined(self):
+        with tempfile.TemporaryDirectory() as fixture_dir:
+            destination = io.BytesIO()
+            stream_gz_files(write_gz_fixtures(fixture_dir), destination)
+            self.assertEqual(destination.getvalue(), b"".join(FIXTURE_CONTENTS))
+
+
+class TestImapBatches(TestCase):
+
+    def test_results_are_yielded_in_input_order(self):
+        completed = []
+        lock = threading.Lock()
+
+        def slow_for_early_batches(batch):
+            time.sleep(0.02 * (8 - batch[0]))
+            with lock:
+                completed.append(batch[0])
+            return sum(batch)
+
+        batches = ([index, index * 10] for index in range(8))
+        results = list(imap_batches(slow_for_early_batches, batches, 4, on_complete=lambda batch: None))
+        self.assertListEqual(results, [([index, index * 10], index * 11) for index in range(8)])
+        self.assertNotEqual(completed, sorted(completed))
+
+    def test_every_batch_is_reported_as_it_completes(self):
+        reported = []
+        results = list(imap_batches(len, ([0] * size for size in [3, 1, 2]), 2, on_complete=reported.append))
+        self.assertListEqual([result for _, result in results], [3, 1, 2])
+        self.assertListEqual(sorted(reported), [[0], [0, 0], [0, 0, 0]])
+
+
+class TestGetConfig(TestCase):
+
+    def setUp(self):
+        get_config.cache_clear()
+
+    def tearDown(self):
+        get_config.cache_clear()
+
+    def test_dangling_virus_db_link_is_left_in_place(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            virus_db_store = Path(work_dir) / "virus_db_store"
+            virus_db_store.symlink_to("virus_db_store.build-1")
+            config_path = Path(work_dir) / "config.json"
+            config_path.write_text(json.dumps({**CONFIG_TEMPLATE,
+                                               "operational_data_storage": f"{work_dir}/ops/",
+                                               "virus_db_storage": f"{virus_db_store}/",
+                                               "genome_db_storage": f"{work_dir}/genome_db_store/"}))
+            with patch("ervin.ervin_utils.CONFIG_PATH", config_path):
+                config = get_config()
+            self.assertEqual(config.virus_db_storage, f"{virus_db_store}/")
+            self.assertTrue(virus_db_store.is_symlink())
+            self.assertTrue((Path(work_dir) / "genome_db_store").is_dir())
@@ -0,0 +1,58 @@
+from unittest import TestCase
+from ervin.exceptions import FastaFormatException
+from ervin.fasta_index import FastaIndex, fai_path_for
+import os
+import random
+import tempfile
+
+
+def write_fasta(path, records, line_width):
+    with open(path, "w") as fasta_out:
+        for name, sequence in records.items():
+            fasta_out.write(f">{name} some description\n")
+            for start in range(0, len(sequence), line_width):
+                fasta_out.write(f"{sequence[start:start + line_width]}\n")
+
+
+class TestFastaIndex(TestCase):
+
+    def setUp(self) -> None:
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.fasta_path = os.path.join(self.work_dir.name, "genome.fasta")
+        generator = random.Random(0)
+        self.records = {f"scaf{count}": "".join(generator.choice("ACGT") for _ in range(generator.randrange(1, 500)))
+                        for count in range(20)}
+        write_fasta(self.fasta_path, self.records, 60)
+
+    def tearDown(self) -> None:
+        self.work_dir.cleanup()
+
+    def test_fetch_matches_slicing(self):
+        generator = random.Random(1)
+        with FastaIndex(self.fasta_path) as index:
+            for name, sequence in self.records.items():
+                for _ in range(50):
+                    start = generator.randrange(-600, 600)
+                    end = generator.randrange(-600, 600)
+                    self.assertEqual(sequence[start:end], index.fetch(name, start, end))
+
+    def test_index_is_cached_next_to_fasta(self):
+        FastaIndex(self.fasta_path).close()
+        self.assertTrue(fai_path_for(self.fasta_path).exists())
+        with FastaIndex(self.fasta_path) as index:
+            self.assertEqual(index.sequence_length("scaf3"), len(self.records["scaf3"]))
+
+    def test_index_older_than_fasta_is_rebuilt(self):
+        FastaIndex(self.fasta_path).close()
+        write_fasta(self.fasta_path, {"scaf0": "TTTTGGGG" * 20}, 7)
+        rewritten_at = os.stat(fai_path_for(self.fasta_path)).st_mtime + 10
+        os.utime(self.fasta_path, (rewritten_at, rewritten_at))
+        with FastaIndex(self.fasta_path) as index:
+            self.assertNotIn("scaf3", index)
+            self.assertEqual(index.fetch("scaf0", 5, 20), ("TTTTGGGG" * 20)[5:20])
+
+    def test_inconsistent_line_lengths_rejected(self):
+        with open(self.fasta_path, "w") as fasta_out:
+            fasta_out.write(">scaf\nACGT\nAC\nACGT\n")
+        with self.assertRaises(FastaFormatException):
+            FastaIndex(self.fasta_path)
@@ -1,7 +1,10 @@
 from unittest import TestCase
-from ervin.ervin_utils import read_and_sanitise_raw_data, read_from_fasta_file
-from mock import patch, mock_open
+from ervin.ervin_utils import read_and_sanitise_raw_data, read_from_fasta_file, total_result_records
+from ervin.probe_blaster import blast_probes, run_blast_batch_lines
+from mock import Mock, patch, mock_open
 import os
+import tempfile
+import time
 
 
 def dummy_raw_data():
@@ -24,16 +27,59 @@ def dummy_expected_sanitised_data():
     ]
 
 
+def fake_tblastn(program, query=None, parse_line=None, **options):
+    # Reports a hit per query under its query title, reversing the order the queries went in
+    titles = [line[1:] for line in query.splitlines() if line.startswith(">")]
+    return [parse_line(f"{title}\tscaf\t100000\t1\t901\t1e-50\t300\tMKLV\tACGT\t1") for title in reversed(titles)]
+
+
+def slow_fake_tblastn(program, query=None, parse_line=None, **options):
+    # Hits carry each probe's sequence length as their alignment length, and batches holding longer probes take
+    # less time, so that batches finish out of order
+    queries = query.splitlines()
+    lengths = [len(sequence) for sequence in queries[1::2]]
+    time.sleep(0.1 / max(lengths))
+    return [parse_line(f"{title[1:]}\tscaf\t100000\t1\t901\t1e-50\t{400 + length}\tMKLV\tACGT\t1")
+            for title, length in zip(queries[::2], lengths)]
+
+
 class TestProbeBlaster(TestCase):
 
+    @patch("ervin.probe_blaster.get_config", return_value=Mock(genome_db_storage="/dbs/", probe_hit_cache_size=0))
+    @patch("ervin.probe_blaster.run_blast_program", side_effect=slow_fake_tblastn)
+    def test_parallel_jobs_give_results_in_probe_order(self, *_):
+        with tempfile.TemporaryDirectory() as work_dir:
+            probe_file = os.path.join(work_dir, "probes.fasta")
+            with open(probe_file, "w") as file_out:
+                for index in range(1, 13):
+                    file_out.write(f">probe{index}\n{'M' * index}\n")
+            expected = [(probe["title"], [result.to_tsv() for result in results])
+                        for probe, results in blast_probes(probe_file, "gdb", 404, 0.01, batch_size=2, jobs=1)]
+            actual = [(probe["title"], [result.to_tsv() for result in results])
+                      for probe, results in blast_probes(probe_file, "gdb", 404, 0.01, batch_size=2, jobs=4)]
+        self.assertListEqual(actual, expected)
+        self.assertListEqual([title for title, _ in actual], [f">probe{index}" for index in range(1, 13)])
+        self.assertListEqual([len(results) for _, results in actual], [0] * 4 + [1] * 8)
+
+    @patch("ervin.probe_blaster.get_config", return_value=Mock(genome_db_storage="/dbs/"))
+    @patch("ervin.probe_blaster.run_blast_program", side_effect=fake_tblastn)
+    def test_hits_are_matched_to_probes_by_position(self, *_):
+        probes = [{"title": ">gi|123|ref|NC_1.1| probe one", "seq": "MKLV"},
+                  {"title": ">dup", "seq": "MKLA"},
+                  {"title": ">dup", "seq": "MKLG"},
+                  {"title": ">", "seq": "MKLT"}]
+        lines = run_blast_batch_lines(probes, "gdb", 0.01)
+        self.assertListEqual([[line.split("\t")[0] for line in probe_lines] for probe_lines in lines],
+                             [["gi|123|ref|NC_1.1|"], ["dup"], ["dup"], [""]])
+
     @patch("builtins.open", new_callable=mock_open, read_data=dummy_raw_data())
     def test_raw_data_correctly_sanitised(self, *_):
         expected_data = dummy_expected_sanitised_data()
         actual_data = read_and_sanitise_raw_data("some_filename")
         self.assertListEqual(expected_data, actual_data)
 
-    @patch("ervin.ervin_utils.read_and_sanitise_raw_data", return_value=dummy_expected_sanitised_data())
-    def test_read_probe_records(self, mock_read_data):
+    @patch("builtins.open", new_callable=mock_open, read_data=dummy_raw_data())
+    def test_read_probe_records(self, mock_file):
         expected_records = [
             {
                 "title": ">something",
@@ -45,5 +91,31 @@ class TestProbeBlaster(TestCase):
             }
         ]
         actual_records = read_from_fasta_file("filename")
-        mock_read_data.assert_called_once_with("filename")
+        mock_file.assert_called_once_with("filename")
         self.assertListEqual(expected_records, actual_records)
+
+    @patch("builtins.open", new_callable=mock_open, read_data=">repeated\nfirst\n>repeated\nsecond\n")
+    def test_read_probe_records_with_repeated_titles(self, *_):
+        expected_records = [
+            {
+                "title": ">repeated",
+                "seq": "first"
+            },
+            {
+                "title": ">repeated",
+                "seq": "second"
+            }
+        ]
+        self.assertListEqual(expected_records, read_from_fasta_file("filename"))
+
+    def test_total_result_records_counts_unterminated_last_line(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            terminated = os.path.join(work_dir, "terminated.tsv")
+            unterminated = os.path.join(work_dir, "unterminated.tsv")
+            empty = os.path.join(work_dir, "empty.tsv")
+            with open(terminated, "w") as file_out:
+                file_out.write("a\nb\n")
+            with open(unterminated, "w") as file_out:
+                file_out.write("a\nb\nc")
+            open(empty, "w").close()
+            self.assertEqual(total_result_records([terminated, unterminated, empty]), 5)
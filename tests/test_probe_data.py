@@ -0,0 +1,50 @@
+from unittest import TestCase
+from ervin.probe_data import ProbeData
+from math import ceil
+import pickle
+import random
+
+
+def make_record(accession_id, start, end, alignment):
+    return ProbeData(f"{accession_id}\tscaf\t100000\t{start}\t{end}\t1e-50\t{len(alignment)}\tMKLV\t{alignment}\t1")
+
+
+def merge_strings(a, b):
+    # The alignment each merge is expected to produce, built directly on strings
+    first, second = (a, b) if a.start < b.start else (b, a)
+    if first.end < second.start:
+        return first.scaffold_alignment + "-" * ceil((second.start - first.end) / 3) + second.scaffold_alignment
+    return first.scaffold_alignment + second.scaffold_alignment[ceil((first.end - second.start) / 3):]
+
+
+class TestProbeData(TestCase):
+
+    def test_merged_alignment_matches_string_merge(self):
+        generator = random.Random(0)
+        for _ in range(50):
+            chain = make_record("a0", 100, 400, "AC-GT" * 20)
+            expected_alignment = chain.scaffold_alignment
+            for index in range(1, 40):
+                start = chain.end + generator.randrange(-150, 50) if generator.random() < 0.8 \
+                    else chain.start - generator.randrange(100, 300)
+                end = start + generator.randrange(90, 600)
+                if chain.start <= start and end <= chain.end or start == chain.end or end == chain.start:
+                    continue
+                record = make_record(f"a{index}", start, end,
+                                     "".join(generator.choice("ACGT-") for _ in range((end - start) // 3)))
+                expected_alignment = merge_strings(chain, record) if chain.start < record.start \
+                    else merge_strings(record, chain)
+                chain = ProbeData.merge_records(chain, record)
+                self.assertEqual(chain.alignment_length,
+                                 (chain.end - chain.start) - expected_alignment.count("-"))
+            self.assertEqual(chain.scaffold_alignment, expected_alignment)
+            self.assertEqual(chain.to_tsv().split("\t")[8], expected_alignment)
+
+    def test_merged_record_copies_and_pickles_with_its_alignment(self):
+        merged = ProbeData.merge_records(make_record("a", 100, 400, "ACGT-A"), make_record("b", 430, 700, "GG-C"))
+        self.assertEqual(ProbeData(merged, {}).scaffold_alignment, "ACGT-A----------GG-C")
+        self.assertEqual(pickle.loads(pickle.dumps(merged)).scaffold_alignment, "ACGT-A----------GG-C")
+
+    def test_records_meeting_end_to_start_do_not_merge(self):
+        with self.assertRaises(KeyError):
+            ProbeData.merge_records(make_record("a", 100, 400, "ACGT"), make_record("b", 400, 700, "ACGT"))
@@ -0,0 +1,159 @@
+from unittest import TestCase
+from ervin.ervin_utils import iter_fasta_file
+from ervin.probe_blaster import print_results
+from ervin.probe_data import ProbeData
+from ervin.probe_finder import Args, find_probes, find_probes_recursively, find_probes_single_pass, fold_probe_data, \
+    iter_merged_scaffolds, merge_executor, merge_scaffold_records_pairwise, read_probe_records_from_file, \
+    run_probe_finder, run_probe_finder_on_records, set_up_output_files, write_probe_finder_output
+from mock import patch
+from pathlib import Path
+import gzip
+import random
+import tempfile
+
+
+def make_record(accession_id, scaffold, start, end, frame, alignment_length=500):
+    first, second = (start, end) if frame > 0 else (end, start)
+    alignment = "ACGT" * ((end - start) // 12)
+    return ProbeData(f"{accession_id}\t{scaffold}\t100000\t{first}\t{second}\t1e-50\t{alignment_length}\t"
+                     f"MKLV\t{alignment}\t{frame}")
+
+
+def random_probe_data(seed, record_count):
+    generator = random.Random(seed)
+    probe_data = {}
+    for count in range(record_count):
+        scaffold = f"scaf{generator.randrange(3)}"
+        start = generator.randrange(1, 20000) * 3
+        end = start + generator.randrange(30, 600) * 3 + 1
+        record = make_record(f"acc{count}", scaffold, start, end, generator.choice([1, 2, -1, -2]),
+                             generator.randrange(300, 700))
+        probe_data.setdefault(scaffold, []).append(record)
+    return probe_data
+
+
+def tsv_lines(output_data):
+    return sorted(record.to_tsv() for records in output_data.values() for record in records)
+
+
+def record_spans(output_data):
+    return {(record.scaffold, record.start, record.end, record.frame)
+            for records in output_data.values() for record in records}
+
+
+def ordered_tsv_lines(output_data):
+    return [(scaffold, [record.to_tsv() for record in records]) for scaffold, records in output_data.items()]
+
+
+class TestProbeFinder(TestCase):
+
+    def test_near_neighbours_are_merged(self):
+        first = make_record("a", "scaf", 100, 400, 1)
+        second = make_record("b", "scaf", 430, 700, 1)
+        result = find_probes(Args([], None), {"scaf": [first]}, {"scaf": [second]})
+        merged, = result["scaf"]
+        self.assertEqual((merged.start, merged.end, merged.accession_id), (100, 700, "a_b"))
+
+    def test_indexed_merge_matches_pairwise_merge(self):
+        args = Args([], 400)
+        for seed in range(20):
+            expected = find_probes(args, random_probe_data(seed, 300), random_probe_data(seed + 100, 300),
+                                   merge_scaffold=merge_scaffold_records_pairwise)
+            actual = find_probes(args, random_probe_data(seed, 300), random_probe_data(seed + 100, 300))
+            self.assertListEqual(tsv_lines(expected), tsv_lines(actual))
+
+    def test_indexed_self_merge_matches_pairwise_self_merge(self):
+        args = Args([], None)
+        for seed in range(20):
+            expected_data = random_probe_data(seed, 300)
+            expected = find_probes(args, expected_data, expected_data, merge_scaffold=merge_scaffold_records_pairwise)
+            actual_data = random_probe_data(seed, 300)
+            actual = find_probes(args, actual_data, actual_data)
+            self.assertListEqual(tsv_lines(expected), tsv_lines(actual))
+
+    def test_per_scaffold_fold_matches_fold(self):
+        for source_count in [1, 2, 3, 5]:
+            for seed in range(10):
+                sources = [random_probe_data(seed * 10 + index, 60) for index in range(source_count)]
+                expected = fold_probe_data([random_probe_data(seed * 10 + index, 60)
+                                            for index in range(source_count)], Args([], 400))
+                record_groups = [[record for records in source.values() for record in records] for source in sources]
+                actual = dict(iter_merged_scaffolds(record_groups, 400))
+                self.assertListEqual(tsv_lines(expected), tsv_lines(actual))
+
+    def test_single_pass_matches_fold_over_files(self):
+        file_records = [
+            [make_record("a1", "scaf", 100, 400, 1), make_record("b1", "scaf", 2000, 2300, -1),
+             make_record("c1", "other", 500, 900, 2)],
+            [make_record("a2", "scaf", 350, 800, 1), make_record("b2", "scaf", 2250, 2600, -1),
+             make_record("c2", "other", 500, 900, 2)],
+            [make_record("a3", "scaf", 780, 1200, 1), make_record("b3", "scaf", 1900, 2100, -1),
+             make_record("a4", "scaf", 100, 400, 1), make_record("c3", "other", 880, 1300, 2)],
+        ]
+        with tempfile.TemporaryDirectory() as input_dir:
+            file_list = []
+            for index, records in enumerate(file_records):
+                input_file = Path(input_dir) / f"probe{index}.tsv"
+                input_file.write_text("".join(record.to_tsv() for record in records))
+                file_list.append(str(input_file))
+            args = Args(file_list, None)
+            expected = record_spans(find_probes_recursively(file_list, args))
+            single_pass = find_probes_single_pass(file_list, args)
+            self.assertSetEqual(record_spans(single_pass), expected)
+            self.assertEqual(sum(len(records) for records in single_pass.values()), len(expected))
+
+    @patch("ervin.probe_finder.MERGE_CHUNK_RECORDS", 50)
+    def test_pool_merge_matches_in_process_merge(self):
+        args = Args([], 400)
+        with merge_executor(2) as executor:
+            for source_count in [1, 2, 3]:
+                for seed in range(5):
+                    expected = fold_probe_data([random_probe_data(seed * 10 + index, 200)
+                                                for index in range(source_count)], args)
+                    actual = fold_probe_data([random_probe_data(seed * 10 + index, 200)
+                                              for index in range(source_count)], args, executor)
+                    self.assertListEqual(ordered_tsv_lines(expected), ordered_tsv_lines(actual))
+            probe_data = random_probe_data(0, 300)
+            self.assertListEqual(ordered_tsv_lines(find_probes(args, probe_data, probe_data)),
+                                 ordered_tsv_lines(find_probes(args, probe_data, probe_data, executor=executor)))
+
+    @patch("ervin.probe_finder.MERGE_CHUNK_RECORDS", 50)
+    def test_pool_per_scaffold_merge_matches_in_process_merge(self):
+        record_groups = [[record for records in random_probe_data(seed, 200).values() for record in records]
+                         for seed in range(4)]
+        for single_pass in [False, True]:
+            expected = dict(iter_merged_scaffolds(record_groups, 400, single_pass))
+            actual = dict(iter_merged_scaffolds(record_groups, 400, single_pass, jobs=2))
+            self.assertListEqual(ordered_tsv_lines(expected), ordered_tsv_lines(actual))
+
+    def test_streamed_hits_match_hits_written_and_read_back(self):
+        # Each probe's hits are sorted once on either path, as ervin's stream_probe_hits and print_results do
+        record_groups = [[record for records in random_probe_data(seed, 80).values() for record in records]
+                         for seed in range(4)]
+        with tempfile.TemporaryDirectory() as work_dir, patch("ervin.probe_finder.TEMP_PROBE_FINDER", work_dir):
+            outputs = [run_probe_finder_on_records([sorted(records) for records in record_groups], 400, "streamed")]
+            for export_tsv in [False, True]:
+                probe_files = [print_results(records, f">probe{index}", "read_back", f"{work_dir}/{export_tsv}",
+                                             export_tsv)
+                               for index, records in enumerate(record_groups)]
+                outputs.append(run_probe_finder(probe_files, 400, f"read_back_{export_tsv}"))
+            output_tsvs = [Path(fasta).with_suffix(".tsv").read_text() for fasta, _ in outputs]
+        streamed_count = outputs[0][1]
+        self.assertGreater(streamed_count, 0)
+        self.assertListEqual([count for _, count in outputs], [streamed_count] * 3)
+        self.assertListEqual(output_tsvs, [output_tsvs[0]] * 3)
+
+    @patch("ervin.probe_finder.OUTPUT_BATCH_RECORDS", 7)
+    def test_output_files_read_back_with_any_compression(self):
+        result = random_probe_data(0, 100)
+        expected_fasta = [{"title": title, "seq": seq} for title, seq in
+                          (record.to_fasta().splitlines() for record in sorted(sum(result.values(), [])))]
+        for compression in [None, "gzip", "bgzip"]:
+            with tempfile.TemporaryDirectory() as output_dir:
+                fasta_output, tsv_output = set_up_output_files(output_dir, "ts", compression)
+                self.assertEqual(write_probe_finder_output((fasta_output, tsv_output), result, compression), 100)
+                if compression is not None:
+                    with gzip.open(tsv_output) as tsv_in:
+                        tsv_in.read()
+                self.assertListEqual(list(iter_fasta_file(fasta_output)), expected_fasta)
+                self.assertListEqual(tsv_lines(read_probe_records_from_file(tsv_output)), tsv_lines(result))
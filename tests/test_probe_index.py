@@ -0,0 +1,21 @@
+from unittest import TestCase
+from ervin.probe_index import merge_partner_mask
+from tests.test_probe_finder import make_record
+import numpy as np
+import random
+
+
+class TestProbeIndex(TestCase):
+
+    def test_partner_mask_matches_record_checks(self):
+        generator = random.Random(0)
+        records = []
+        for count in range(400):
+            start = generator.randrange(1, 300) * 3
+            records.append(make_record(f"acc{count}", "scaf", start, start + generator.randrange(1, 100) * 3 + 1, 1))
+        starts = np.array([record.start for record in records])
+        ends = np.array([record.end for record in records])
+        for record in records[:50]:
+            expected = [record.is_superset(comparitor) or record.is_near_neighbour(comparitor)
+                        or record.is_range_extension(comparitor) for comparitor in records]
+            self.assertListEqual(expected, merge_partner_mask(record.start, record.end, starts, ends).tolist())
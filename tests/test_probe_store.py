@@ -0,0 +1,65 @@
+from unittest import TestCase
+from ervin.exceptions import InvalidProbeStoreException
+from ervin.probe_data import ProbeData
+from ervin.probe_finder import read_probe_records_from_files
+from ervin.probe_store import ProbeStore, append_probe_store, count_probe_records, export_probe_store_to_tsv, \
+    read_probe_store, write_probe_store
+from pathlib import Path
+from tests.test_probe_table import dummy_tsv_lines
+import tempfile
+
+
+class TestProbeStore(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.store_path = Path(self.work_dir.name) / "hits.probes"
+        self.records = [ProbeData(line) for line in dummy_tsv_lines()]
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_round_trip(self):
+        write_probe_store(self.store_path, self.records)
+        self.assertListEqual([record.to_tsv() for record in read_probe_store(self.store_path)], dummy_tsv_lines())
+        self.assertEqual(count_probe_records([self.store_path, self.store_path]), 6)
+        tsv_path = export_probe_store_to_tsv(self.store_path, Path(self.work_dir.name) / "hits.tsv")
+        self.assertListEqual(tsv_path.read_text().splitlines(keepends=True), dummy_tsv_lines())
+
+    def test_appended_stores_read_back_from_their_offsets(self):
+        with open(self.store_path, "ab") as store_out:
+            store_out.write(b"partial")
+            offsets = [append_probe_store(store_out, self.records[:2]), append_probe_store(store_out, self.records[2:])]
+        self.assertListEqual([offset % 8 for offset in offsets], [0, 0])
+        self.assertListEqual([record.to_tsv() for record in read_probe_store(self.store_path, offset=offsets[0])],
+                             dummy_tsv_lines()[:2])
+        self.assertListEqual([record.to_tsv() for record in read_probe_store(self.store_path, offset=offsets[1])],
+                             dummy_tsv_lines()[2:])
+
+    def test_sequences_can_be_skipped(self):
+        write_probe_store(self.store_path, self.records)
+        with ProbeStore(self.store_path) as store:
+            table = store.to_table(include_sequences=False)
+        self.assertListEqual(table.scaffold_alignments, ["", "", ""])
+        self.assertListEqual(table.accession_ids, ["acc1", "acc1", "acc2"])
+
+    def test_large_coordinates_are_kept(self):
+        line = "acc1\tchr1\t4000000000\t3000000000\t3000000300\t1e-50\t450\tMKLV\tACGT\t1\n"
+        write_probe_store(self.store_path, [ProbeData(line)])
+        self.assertListEqual([record.to_tsv() for record in read_probe_store(self.store_path)], [line])
+
+    def test_empty_store(self):
+        write_probe_store(self.store_path, [])
+        self.assertEqual(len(read_probe_store(self.store_path)), 0)
+
+    def test_probe_finder_reads_stores_and_tsv(self):
+        write_probe_store(self.store_path, self.records[:2])
+        tsv_path = Path(self.work_dir.name) / "hits.tsv"
+        tsv_path.write_text(dummy_tsv_lines()[2])
+        probe_data = read_probe_records_from_files([self.store_path, tsv_path])
+        self.assertListEqual([record.accession_id for record in probe_data["scaf1"]], ["acc1", "acc2"])
+
+    def test_text_file_is_rejected(self):
+        self.store_path.write_text(dummy_tsv_lines()[0])
+        with self.assertRaises(InvalidProbeStoreException):
+            ProbeStore(self.store_path)
@@ -0,0 +1,30 @@
+from unittest import TestCase
+from ervin.probe_data import ProbeData
+from ervin.probe_table import ProbeTable
+
+
+def dummy_tsv_lines():
+    return [
+        "acc1\tscaf1\t100000\t100\t400\t1e-50\t450\tMKLV\tACGT\t1\n",
+        "acc1\tscaf2\t200000\t900\t300\t1e-20\t420\tMKLA\tAC-T\t-2\n",
+        "acc2\tscaf1\t100000\t1000\t1300\t1e-30\t410\tMKLF\tTTGA\t3\n",
+    ]
+
+
+class TestProbeTable(TestCase):
+
+    def test_table_rows_match_parsed_records(self):
+        table = ProbeTable()
+        for line in dummy_tsv_lines():
+            table.append_tsv_line(line)
+        self.assertEqual(len(table), 3)
+        self.assertListEqual([ProbeData(line).to_tsv() for line in dummy_tsv_lines()],
+                             [record.to_tsv() for record in table])
+        self.assertEqual(table[1].direction, "N")
+
+    def test_alignment_length_filter(self):
+        table = ProbeTable(ProbeData(line) for line in dummy_tsv_lines())
+        filtered = table.above_alignment_length(415)
+        self.assertListEqual([record.to_tsv() for record in filtered],
+                             [ProbeData(line).to_tsv() for line in dummy_tsv_lines()[:2]])
+        self.assertIs(table.above_alignment_length(None), table)
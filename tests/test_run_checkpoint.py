@@ -0,0 +1,63 @@
+from unittest import TestCase
+from ervin.exceptions import RunNotFoundException
+from ervin.run_checkpoint import RunCheckpoint
+from mock import Mock, patch
+import tempfile
+
+
+class TestRunCheckpoint(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        config = Mock(operational_data_storage=self.work_dir.name)
+        self.config_patch = patch("ervin.run_checkpoint.get_config", return_value=config)
+        self.config_patch.start()
+
+    def tearDown(self):
+        self.config_patch.stop()
+        self.work_dir.cleanup()
+
+    def test_stages_survive_reload(self):
+        checkpoint = RunCheckpoint.create("2020-01-01_00-00-00", {"file": "probes.fasta", "e_value": None})
+        checkpoint.complete_stage("probe_finder", probe_count=10, fasta_count=2)
+        reloaded = RunCheckpoint.load("2020-01-01_00-00-00")
+        self.assertEqual(reloaded.run_args, {"file": "probes.fasta", "e_value": None})
+        self.assertTrue(reloaded.is_complete("probe_finder"))
+        self.assertFalse(reloaded.is_complete("virus_blaster"))
+        self.assertEqual(reloaded.stage_outputs("probe_finder"), {"probe_count": 10, "fasta_count": 2})
+
+    def test_missing_run_raises(self):
+        with self.assertRaises(RunNotFoundException):
+            RunCheckpoint.load("2020-01-01_00-00-00")
+
+    def test_partial_unit_is_dropped(self):
+        checkpoint = RunCheckpoint.create("2020-01-01_00-00-00", {})
+        with checkpoint.unit_log("virus_blaster") as unit_log:
+            unit_log.record(0, top_hit="virus one")
+            unit_log.record(1, top_hit="not_found")
+        with open(checkpoint.units_path("virus_blaster"), "a") as units_out:
+            units_out.write('{"unit": 2, "top_h')
+        self.assertEqual(checkpoint.completed_units("virus_blaster"),
+                         {0: {"top_hit": "virus one"}, 1: {"top_hit": "not_found"}})
+        with checkpoint.unit_log("virus_blaster") as unit_log:
+            unit_log.record(2, top_hit="virus two")
+        self.assertEqual(checkpoint.completed_units("virus_blaster")[2], {"top_hit": "virus two"})
+
+    def test_new_run_starts_without_leftover_units(self):
+        checkpoint = RunCheckpoint.create("2020-01-01_00-00-00", {})
+        checkpoint.unit_data_path("probe_blaster", ".probes").write_bytes(b"hits")
+        with checkpoint.unit_log("virus_blaster") as unit_log:
+            unit_log.record(0, top_hit="virus one")
+        checkpoint = RunCheckpoint.create("2020-01-01_00-00-00", {})
+        self.assertEqual(checkpoint.completed_units("virus_blaster"), {})
+        self.assertFalse(checkpoint.unit_data_path("probe_blaster", ".probes").exists())
+
+    def test_discarded_run_is_removed(self):
+        checkpoint = RunCheckpoint.create("2020-01-01_00-00-00", {})
+        with checkpoint.unit_log("virus_blaster") as unit_log:
+            unit_log.record(0, top_hit="virus one")
+        checkpoint.unit_data_path("probe_blaster", ".probes").write_bytes(b"hits")
+        checkpoint.discard()
+        self.assertFalse(checkpoint.run_dir.exists())
+        with self.assertRaises(RunNotFoundException):
+            RunCheckpoint.load("2020-01-01_00-00-00")
@@ -0,0 +1,50 @@
+from unittest import TestCase
+from ervin.sequence_hunter import find_sequence_segments, read_scaf_records, stream_wanted_sequences
+from mock import patch
+from pathlib import Path
+import tempfile
+
+GENOME_FASTA = ">scaf1 first scaffold\nACGTACGTAC\nGGGGCCCCAA\nTT\n" \
+               ">scaf2\nTTTTTTTTTT\n" \
+               ">scaf3 third\nAAAACCCCGG\nGGTT\n"
+
+
+class TestSequenceHunter(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.fasta_path = Path(self.work_dir.name) / "genome.fasta"
+        self.fasta_path.write_text(GENOME_FASTA)
+        self.scaf_path = Path(self.work_dir.name) / "scaf.txt"
+        self.output_path = Path(self.work_dir.name) / "output.txt"
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def find_segments(self, scaf_lines):
+        self.scaf_path.write_text("".join(scaf_lines))
+        with patch("ervin.sequence_hunter.input_filepath", str(self.scaf_path)), \
+                patch("ervin.sequence_hunter.output_filepath", str(self.output_path)), \
+                patch("ervin.sequence_hunter.fasta_filepath", str(self.fasta_path)):
+            find_sequence_segments()
+        return self.output_path.read_text().splitlines()
+
+    def test_only_wanted_multi_line_sequences_are_joined(self):
+        self.assertListEqual(list(stream_wanted_sequences(self.fasta_path, {"scaf1", "scaf3"})),
+                             [("scaf1", "ACGTACGTACGGGGCCCCAATT"), ("scaf3", "AAAACCCCGGGGTT")])
+
+    def test_segments_on_one_scaffold_are_all_written(self):
+        self.scaf_path.write_text("scaf1\t8\t14\nscaf1\t20\t2\n")
+        scaf_records = read_scaf_records(self.scaf_path)
+        self.assertListEqual([(record.start, record.end, record.direction) for record in scaf_records["scaf1"]],
+                             [(8, 14, "P"), (2, 20, "N")])
+        self.assertListEqual(self.find_segments(["scaf1\t8\t14\n", "scaf1\t20\t2\n", "scaf3\t0\t6\n"]),
+                             [">scaf1_8_14_P", "ACGGGG", ">scaf1_2_20_N", "AACCCCGGGGCATGCATG",
+                              ">scaf3_0_6_P", "AAAACC"])
+
+    def test_scaffolds_missing_from_the_fasta_are_skipped(self):
+        self.assertListEqual(self.find_segments(["scaf9\t1\t5\n", "scaf2\t0\t4\n"]), [">scaf2_0_4_P", "TTTT"])
+
+    def test_segments_past_the_end_of_a_scaffold_are_cut_short(self):
+        self.assertListEqual(self.find_segments(["scaf2\t6\t40\n", "scaf2\t50\t60\n"]),
+                             [">scaf2_6_40_P", "TTTT", ">scaf2_50_60_P", ""])
@@ -0,0 +1,37 @@
+from unittest import TestCase
+from ervin.ervin_utils import read_from_fasta_file
+from ervin.virus_blaster import VIRUS_NOT_FOUND, VirusFileWriter, get_top_virus_hits
+from mock import Mock, patch
+from pathlib import Path
+import tempfile
+
+
+class TestGetTopVirusHits(TestCase):
+
+    @patch("ervin.virus_blaster.get_config", return_value=Mock(virus_db_storage="/db/"))
+    @patch("ervin.virus_blaster.run_blast_program")
+    def test_hits_are_matched_to_queries_by_position(self, run_blast_program, _):
+        run_blast_program.return_value = iter([["q0", "virus a"], ["q0", "virus b"], ["q2", "virus c"]])
+        records = [{"title": ">scaf1 100 400 P", "seq": "MKLV"},
+                   {"title": ">scaf1 100 400 P", "seq": "MKLA"},
+                   {"title": ">scaf2 900 300 N", "seq": "MKLF"},
+                   {"title": ">scaf3 10 70 P", "seq": "MKLW"}]
+        self.assertListEqual(get_top_virus_hits(records, "Viruses"),
+                             ["virus a", VIRUS_NOT_FOUND, "virus c", VIRUS_NOT_FOUND])
+        self.assertEqual(run_blast_program.call_args[1]["query"], ">q0\nMKLV\n>q1\nMKLA\n>q2\nMKLF\n>q3\nMKLW\n")
+
+
+class TestVirusFileWriter(TestCase):
+
+    def test_records_survive_handle_eviction_and_are_counted(self):
+        virus_names = ["virus a", "virus/b", "virus?b", "virus c", "virus a", "virus c", "virus a"]
+        with tempfile.TemporaryDirectory() as output_dir:
+            with VirusFileWriter(output_dir, "ts", max_open_files=2) as virus_files:
+                for index, virus_name in enumerate(virus_names):
+                    virus_files.write(virus_name, {"title": f">record{index}", "seq": "MKLV"})
+                    self.assertLessEqual(len(virus_files._handles), 2)
+            self.assertDictEqual(virus_files.virus_to_count, {"virus a": 3, "virus_b": 2, "virus c": 2})
+            self.assertSetEqual({path.name for path in Path(output_dir).iterdir()},
+                                {"virus a_ts.fasta", "virus_b_ts.fasta", "virus c_ts.fasta"})
+            self.assertListEqual([record["title"] for record in read_from_fasta_file(virus_files.filenames["virus a"])],
+                                 [">record0", ">record4", ">record6"])
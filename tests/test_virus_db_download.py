@@ -0,0 +1,165 @@
+from unittest import TestCase
+from ervin.ervin_utils import VIRUS_DB_SERVER_DIR
+from ervin.ftp_utils import download_files, list_remote_files, list_remote_files_mlsd, partial_download_path
+from ervin.virus_blaster import connect_to_virus_db_server, read_virus_db_manifest, swap_in_virus_db, \
+    update_virus_db, virus_db_staging_dir
+from mock import Mock, patch
+from functools import partial
+from pathlib import Path
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+import gzip
+import os
+import tempfile
+import threading
+
+
+def start_ftp_server(root):
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type("TestFTPHandler", (FTPHandler,), {"authorizer": authorizer})
+    server = FTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"timeout": 0.1}, daemon=True)
+    thread.start()
+    return server, thread
+
+
+class TestVirusDbDownload(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.server_root = Path(self.work_dir.name) / "ftp"
+        self.remote_dir = self.server_root / VIRUS_DB_SERVER_DIR
+        self.remote_dir.mkdir(parents=True)
+        self.contents = {}
+        for count in range(5):
+            name = f"viral.{count}.1.genomic.fna.gz"
+            self.contents[name] = gzip.compress(f">virus{count}\n{'ACGT' * 5000 * (count + 1)}\n".encode())
+            (self.remote_dir / name).write_bytes(self.contents[name])
+        (self.remote_dir / "viral.1.protein.faa.gz").write_bytes(gzip.compress(b">protein\nMKV\n"))
+        self.server, self.server_thread = start_ftp_server(str(self.server_root))
+        self.port = self.server.socket.getsockname()[1]
+        self.connect = partial(connect_to_virus_db_server, "127.0.0.1", self.port)
+
+    def tearDown(self):
+        self.server.close_all()
+        self.server_thread.join()
+        self.work_dir.cleanup()
+
+    def remote_fna_files(self):
+        return [remote_file for remote_file in list_remote_files_mlsd("127.0.0.1", VIRUS_DB_SERVER_DIR, self.port)
+                if ".fna" in remote_file.name]
+
+    def test_mlsd_listing_matches_list_listing(self):
+        mlsd_listing = list_remote_files_mlsd("127.0.0.1", VIRUS_DB_SERVER_DIR, self.port)
+        with self.connect() as ftp_handle:
+            list_listing = list_remote_files(ftp_handle)
+        self.assertEqual(sorted((entry.name, entry.size) for entry in mlsd_listing),
+                         sorted((entry.name, entry.size) for entry in list_listing))
+        for entry in mlsd_listing:
+            self.assertEqual(entry.mtime, int((self.remote_dir / entry.name).stat().st_mtime))
+
+    def test_download_files_concurrently(self):
+        destination = Path(self.work_dir.name) / "download"
+        destination.mkdir()
+        completed = []
+        downloaded = download_files(self.connect, self.remote_fna_files(), destination, 3, completed.append)
+        self.assertEqual(len(completed), 5)
+        self.assertEqual(sorted(filepath.name for filepath in downloaded), sorted(self.contents))
+        for filepath in downloaded:
+            self.assertEqual(filepath.read_bytes(), self.contents[filepath.name])
+        self.assertEqual(list(destination.glob("*.part")), [])
+
+    def test_download_resumes_partial_file(self):
+        destination = Path(self.work_dir.name) / "download"
+        destination.mkdir()
+        remote_file = self.remote_fna_files()[-1]
+        partial_path = partial_download_path(destination / remote_file.name, remote_file)
+        partial_path.write_bytes(self.contents[remote_file.name][:1000])
+        download_files(self.connect, [remote_file], destination, 1)
+        self.assertEqual((destination / remote_file.name).read_bytes(), self.contents[remote_file.name])
+        self.assertFalse(partial_path.exists())
+
+    def test_download_discards_partial_file_of_older_version(self):
+        destination = Path(self.work_dir.name) / "download"
+        destination.mkdir()
+        remote_file = self.remote_fna_files()[0]
+        stale_partial = partial_download_path(destination / remote_file.name,
+                                              remote_file._replace(mtime=remote_file.mtime - 3600))
+        stale_partial.write_bytes(b"out of date bytes")
+        download_files(self.connect, [remote_file], destination, 1)
+        self.assertEqual((destination / remote_file.name).read_bytes(), self.contents[remote_file.name])
+        self.assertFalse(stale_partial.exists())
+
+    def update_virus_db(self, virus_db_store, check_ttl=0):
+        built_volumes = []
+
+        def fake_build_volume(source_file, volume_name, db_dir):
+            built_volumes.append(volume_name)
+            (Path(db_dir) / f"{volume_name}.nsq").write_bytes(gzip.decompress(Path(source_file).read_bytes()))
+            return [f"{volume_name}.nsq"]
+
+        def fake_build_alias(db_name, volume_names, db_dir):
+            (Path(db_dir) / f"{db_name}.nal").write_text(" ".join(volume_names))
+
+        config = Mock(virus_db_storage=f"{virus_db_store}/", operational_data_storage=self.work_dir.name,
+                      virus_db_check_ttl=check_ttl)
+        with patch("ervin.virus_blaster.get_config", return_value=config), \
+                patch("ervin.virus_blaster.build_virus_db_volume", side_effect=fake_build_volume), \
+                patch("ervin.virus_blaster.build_virus_db_alias", side_effect=fake_build_alias):
+            update_virus_db("127.0.0.1", self.port, connections=2)
+        return built_volumes
+
+    def test_update_virus_db_builds_all_volumes_and_swaps(self):
+        virus_db_store = Path(self.work_dir.name) / "virus_db_store"
+        virus_db_store.mkdir()
+        (virus_db_store / "Viruses.nsq").write_bytes(b"old database")
+        self.assertEqual(len(self.update_virus_db(virus_db_store)), 5)
+        self.assertFalse(virus_db_staging_dir(virus_db_store).exists())
+        self.assertFalse((virus_db_store / "Viruses.nsq").exists())
+        self.assertEqual(list(virus_db_store.glob("*.gz")), [])
+        manifest = read_virus_db_manifest(virus_db_store)
+        self.assertEqual(sorted(manifest), sorted(self.contents))
+        self.assertEqual(len((virus_db_store / "Viruses.nal").read_text().split()), 5)
+        self.assertTrue((virus_db_store / "last_updated").exists())
+
+    def test_update_virus_db_rebuilds_only_changed_files(self):
+        virus_db_store = Path(self.work_dir.name) / "virus_db_store"
+        self.update_virus_db(virus_db_store)
+        changed_name = "viral.2.1.genomic.fna.gz"
+        touched_name = "viral.3.1.genomic.fna.gz"
+        (self.remote_dir / changed_name).write_bytes(gzip.compress(b">virus2\nTTTT\n"))
+        for name in [changed_name, touched_name]:
+            new_mtime = (self.remote_dir / name).stat().st_mtime - 600
+            os.utime(self.remote_dir / name, (new_mtime, new_mtime))
+        self.assertEqual(self.update_virus_db(virus_db_store), ["Viruses.viral.2.1.genomic"])
+        self.assertEqual((virus_db_store / "Viruses.viral.2.1.genomic.nsq").read_bytes(), b">virus2\nTTTT\n")
+        self.assertEqual(len(list(virus_db_store.glob("*.nsq"))), 5)
+        manifest = read_virus_db_manifest(virus_db_store)
+        listed_mtimes = {remote_file.name: remote_file.mtime for remote_file in self.remote_fna_files()}
+        self.assertEqual(manifest[touched_name]["mtime"], listed_mtimes[touched_name])
+        self.assertEqual(self.update_virus_db(virus_db_store), [])
+
+    def test_update_virus_db_uses_cached_listing_within_ttl(self):
+        virus_db_store = Path(self.work_dir.name) / "virus_db_store"
+        self.update_virus_db(virus_db_store, check_ttl=3600)
+        changed_name = "viral.2.1.genomic.fna.gz"
+        (self.remote_dir / changed_name).write_bytes(gzip.compress(b">virus2\nTTTT\n"))
+        self.assertEqual(self.update_virus_db(virus_db_store, check_ttl=3600), [])
+        self.assertEqual(self.update_virus_db(virus_db_store, check_ttl=0), ["Viruses.viral.2.1.genomic"])
+
+    def test_swap_flips_the_store_link_between_builds(self):
+        virus_db_store = Path(self.work_dir.name) / "virus_db_store"
+        virus_db_store.mkdir()
+        (virus_db_store / "Viruses.nsq").write_bytes(b"unlinked database")
+        for contents in [b"first build", b"second build"]:
+            staging_dir = virus_db_staging_dir(virus_db_store)
+            staging_dir.mkdir()
+            (staging_dir / "Viruses.nsq").write_bytes(contents)
+            swap_in_virus_db(staging_dir, virus_db_store)
+            self.assertTrue(virus_db_store.is_symlink())
+            self.assertEqual((virus_db_store / "Viruses.nsq").read_bytes(), contents)
+            # Only the live build is left beside the link
+            self.assertEqual(sorted(path.name for path in Path(self.work_dir.name).glob("virus_db_store*")),
+                             ["virus_db_store", os.readlink(virus_db_store)])